@@ -0,0 +1,135 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+''' Seconds a resolved ABV is trusted, a beer's ABV almost never changes '''
+ABV_TTL = 180 * 24 * 60 * 60
+
+''' Seconds before a beer whose ABV was not found is searched again '''
+NEGATIVE_TTL = 3 * 24 * 60 * 60
+
+
+''' Runs of characters a normalized name leaves out '''
+_PUNCTUATION_RE = re.compile(r'[^a-z0-9.]+')
+
+
+def normalize_name(name):
+    ''' Returns a key for name ignoring case, punctuation and spacing '''
+    return ' '.join(_PUNCTUATION_RE.sub(' ', name.lower()).split())
+
+
+class AbvStore(object):
+    ''' Resolved ABVs stored in a SQLite file, keyed by normalized beer name
+
+        A record holds the ABV, or None if it was not found, along with the
+        page it was found on and when it was resolved
+    '''
+    def __init__(self, path, ttl=ABV_TTL, negative_ttl=NEGATIVE_TTL,
+                 refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        ''' Ignore stored records but still save new ones '''
+        self.refresh = refresh
+
+        ''' One connection is shared by every keg worker '''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS abvs ('
+                          'key TEXT PRIMARY KEY, name TEXT, abv REAL, '
+                          'source_url TEXT, resolved_at REAL)')
+        self.conn.commit()
+
+
+    def get(self, name):
+        ''' Returns a tuple of whether a fresh record exists and its ABV '''
+        if self.refresh:
+            return False, None
+
+        with self.lock:
+            row = self.conn.execute('SELECT abv, resolved_at FROM abvs '
+                                    'WHERE key = ?',
+                                    (normalize_name(name),)).fetchone()
+        if row is None:
+            return False, None
+
+        abv, resolved_at = row
+        ttl = self.ttl if abv is not None else self.negative_ttl
+        if time.time() - resolved_at >= ttl:
+            return False, None
+        return True, abv
+
+
+    def put(self, name, abv, source_url=None):
+        ''' Records the ABV of name, None records that it was not found '''
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO abvs VALUES '
+                              '(?, ?, ?, ?, ?)',
+                              (normalize_name(name), name, abv, source_url,
+                               time.time()))
+            self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SingleFlight(object):
+    ''' Runs each lookup once per key, callers asking for a key that is in
+        flight wait on it and callers asking for a finished key reuse it
+
+        Only the latest max_results finished keys are kept if it is given
+    '''
+    def __init__(self, max_results=None):
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.max_results = max_results
+        self.in_flight = {}
+
+        ''' Number of lookups answered without running them again '''
+        self.saved = 0
+
+
+    def do(self, key, func):
+        ''' Returns func(), or the result of an earlier call with key '''
+        with self.lock:
+            if key in self.results:
+                self.saved += 1
+                return self.results[key]
+
+            if key in self.in_flight:
+                self.saved += 1
+                done = self.in_flight[key]
+                leader = False
+            else:
+                done = self.in_flight[key] = threading.Event()
+                leader = True
+
+        if not leader:
+            done.wait()
+            with self.lock:
+                if key in self.results:
+                    return self.results[key]
+                self.saved -= 1
+
+            ''' The leading call failed, so look it up again '''
+            return self.do(key, func)
+
+        try:
+            result = func()
+            with self.lock:
+                self.results[key] = result
+                if self.max_results is not None and \
+                        len(self.results) > self.max_results:
+                    self.results.popitem(last=False)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            done.set()
@@ -1,15 +1,50 @@
 
+import Queue
 import re
-import webbrowser
+import threading
+import time
+from itertools import chain
 from urlparse import urlparse
 
-from utils import get_text, get_html, is_num, unique
+import metrics
+from abvstore import normalize_name
+from utils import (ABV_PATTERN, MAX_SCAN_BYTES, FetchResult, TextScanner,
+                   compile_xpath, fetch, get_fetch_pool, parse_html, scan_url,
+                   split_name, unique)
+
+
+''' A ceiling for ABV content for validation
+
+    We can assume BevMo does not offer kegs with this high of an ABV
+'''
+MAX_ABV = 20.0
+
+''' Marks a candidate ABV page that could not be retrieved '''
+PAGE_FAILED = object()
+
+''' Fields of a keg detail page and the links of search results '''
+NAME_XPATH = '//h1/text()'
+PRICE_XPATH = '//span[@class="ProductDetailItemPrice"]/text()'
+AVAIL_XPATH = '//em/text()'
+DESC_XPATH = '//td[@class="ProductDetailCell"]/p/text()'
+SEARCH_LINKS_XPATH = '//a/@href'
+
+''' A number with or without a decimal pt '''
+NUMBER_RE = re.compile(r'\d+[.]?\d*')
 
 
 
 class BeerKeg(object):
     ''' Beer Keg class '''
-    def __init__(self, url, num_attempts, verbose=False):
+    __slots__ = ('url', 'verbose', 'parsed', 'failed', 'ratio', 'abv',
+                 'abv_resolved',
+                 'num_attempts', 'abv_store', 'abv_lookups', 'hedge',
+                 'source_stats', 'max_scan_bytes', 'name', 'price', 'volume',
+                 'num_avail', 'desc')
+
+    def __init__(self, url, num_attempts, verbose=False, abv_store=None,
+                 abv_lookups=None, hedge=1, source_stats=None,
+                 max_scan_bytes=MAX_SCAN_BYTES):
         ''' url must be a string containing the url for a single BevMo keg '''
         self.url = url
 
@@ -19,14 +54,67 @@ class BeerKeg(object):
         ''' Prevent parsing more than once '''
         self.parsed = False
 
+        ''' Set once parsing found the keg's page could not be retrieved '''
+        self.failed = False
+
         ''' The ratio of gallons of alcohol per dollar '''
         self.ratio = None
 
+        ''' Percentage of alcohol by volume, once it has been resolved '''
+        self.abv = None
+        self.abv_resolved = False
+
         ''' Number of attempts to find ABV '''
         self.num_attempts = num_attempts
 
+        ''' AbvStore checked before searching for the ABV, if any '''
+        self.abv_store = abv_store
+
+        ''' SingleFlight shared by kegs of a crawl so each beer's ABV is only
+            resolved once, if any
+        '''
+        self.abv_lookups = abv_lookups
+
+        ''' Number of candidate ABV pages to fetch concurrently '''
+        self.hedge = hedge
+
+        ''' Bytes of a candidate ABV page to read before giving up on it '''
+        self.max_scan_bytes = max_scan_bytes
+
+        ''' SourceStats ranking candidate ABV pages by their domain, if any '''
+        self.source_stats = source_stats
+
+
+    ''' Fields kept when a keg is saved to the catalog '''
+    FIELDS = ('url', 'name', 'volume', 'price', 'num_avail', 'desc', 'abv',
+              'abv_resolved', 'ratio')
+
+
+    def to_dict(self):
+        ''' Returns the parsed fields, ABV and ratio of the keg '''
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+    @classmethod
+    def from_dict(cls, record, num_attempts=0, **kwargs):
+        ''' Returns a parsed keg restored from a dict made by to_dict
+
+            kwargs are passed to the constructor, for finding the ABV of a
+            keg saved before it was resolved
+        '''
+        keg = cls(record['url'], num_attempts, **kwargs)
+        for field in cls.FIELDS:
+            setattr(keg, field, record[field])
+
+        ''' Records only known from a listing have their page fetched when
+            first needed
+        '''
+        keg.parsed = record.get('parsed', True)
+        return keg
+
 
     def open(self):
+        import webbrowser
         webbrowser.open(self.url)
 
 
@@ -44,69 +132,141 @@ class BeerKeg(object):
 
         self.parsed = True
 
-        html = get_html(self.url)
+        with metrics.timed('keg.fetch'):
+            result = fetch(self.url)
 
+        ''' A page that is gone, failed or is not HTML leaves the keg failed '''
+        html = None
+        if result.status == FetchResult.OK:
+            html = parse_html(result.content, self.url)
+        if html is None:
+            self.failed = True
+            metrics.count('keg.failed')
+
+        with metrics.timed('keg.parse'):
+            self.parse_html(html)
+
+
+    def parse_html(self, html):
+        ''' Parses the fields of a keg from its page, or sets empty fields if
+            the page is None because it could not be retrieved
+        '''
         ''' Attempt to get name and volume '''
         try:
-            self.name = html.xpath('//h1/text()')[0].strip()
-            if '(' in self.name and ')' in self.name:
-                split_name = self.name.split('(')
-                self.name = split_name[0].strip()
-
-                volume = filter(lambda x: is_num(x) if '.' not in x \
-                                else x, split_name[1].strip(')').strip())
-                if is_num(volume):
-                    self.volume = float(volume)
-                else:
-                    self.volume = 0.0
-            else:
-                self.volume = 0.0
+            self.name, self.volume = split_name(
+                compile_xpath(NAME_XPATH)(html)[0])
         except Exception:
             self.name = ''
             self.volume = 0.0
 
         ''' Attempt to get price '''
         try:
-            self.price = float(html.xpath('//span[@class="ProductDetailItemPric\
-                                          e"]/text()')[0].strip().strip('$'))
+            self.price = float(compile_xpath(PRICE_XPATH)(html)[0].strip()
+                               .strip('$').replace(',', ''))
         except Exception:
             self.price = 0.0
 
         ''' Attempt to get number of available kegs '''
         try:
-            self.num_avail = int(html.xpath('//em/text()\
-                                            ')[0].strip().split()[0])
+            self.num_avail = int(compile_xpath(AVAIL_XPATH)(html)[0].strip()
+                                 .split()[0])
         except Exception:
             self.num_avail = 0
 
         ''' Attempt to get description '''
         try:
-            self.desc = html.xpath('//td[@class="ProductDetailCell"]/p/text()\
-                                   ')[0].strip()
+            self.desc = compile_xpath(DESC_XPATH)(html)[0].strip()
         except Exception:
             self.desc = ''
 
 
     def get_abv(self):
-        ''' Attempts to find percentage of alcohol by volume using Bing '''
-        abv = ''
-        found_abv = ''
+        ''' Returns the percentage of alcohol by volume
+
+            Kegs of the same beer in other sizes share one lookup. If the
+            search for it failed, None is returned and the ABV is left
+            unresolved for a later crawl
+        '''
+        if self.abv_resolved:
+            return self.abv
+
+        if not self.parsed:
+            self.parse()
 
-        ''' A ceiling for ABV content for validation
+        ''' There is nothing to search for without the keg's page '''
+        if self.failed or not self.name:
+            return None
+
+        try:
+            with metrics.timed('keg.get_abv'):
+                if self.abv_lookups is None:
+                    self.abv = self.resolve_abv()
+                else:
+                    self.abv = self.abv_lookups.do(normalize_name(self.name),
+                                                   self.resolve_abv)
+        except IOError:
+            metrics.count('abv.failed')
+            if self.verbose:
+                print('ABV search failed for {}'.format(self.name))
+            return None
 
-            We can assume BevMo does not offer kegs with this high of an ABV
+        self.abv_resolved = True
+        return self.abv
+
+
+    def resolve_abv(self):
+        ''' Returns the percentage of alcohol by volume
+
+            Checks the ABV store first, otherwise searches for it and stores
+            the result, including not finding it but not a failed search
         '''
-        max_abv = 20.0
+        if self.abv_store is None or not self.name:
+            return self.search_abv()[0]
+
+        found, abv = self.abv_store.get(self.name)
+        if found:
+            metrics.count('abv.stored')
+            if self.verbose:
+                print('Stored ABV for {} is {}'.format(self.name, abv))
+            return abv
+
+        abv, source_url = self.search_abv()
+        self.abv_store.put(self.name, abv, source_url)
+        return abv
 
+
+    def search_abv(self):
+        ''' Attempts to find percentage of alcohol by volume using Bing
+
+            Returns a tuple of the ABV and the url it was found on. Raises
+            IOError if the search results or every candidate page could not
+            be retrieved, so an outage is never stored as a missing ABV
+        '''
         if not self.parsed:
             self.parse()
 
-        search_url = 'https://www.bing.com/search?q={0}+alcohol+content\
-                     '.format('+'.join(self.name.split()))
-        search_links = get_html(search_url).xpath('//a/@href')
-        new_search_links = search_links[search_links.index('javascript:'):][1:]
+        search_url = ('https://www.bing.com/search?q={0}+alcohol+content'
+                      .format('+'.join(self.name.split())))
+        with metrics.timed('abv.search'):
+            result = fetch(search_url)
+        if result.status == FetchResult.FAILED:
+            raise IOError(result.error)
+
+        search_links = []
+        if result.status == FetchResult.OK:
+            search_html = parse_html(result.content, search_url)
+            if search_html is not None:
+                search_links = compile_xpath(SEARCH_LINKS_XPATH)(search_html)
+
+        ''' Result links follow the first javascript: link, if there is one '''
+        if 'javascript:' in search_links:
+            search_links = search_links[search_links.index('javascript:') + 1:]
+
+        results = [x for x in search_links if x != '#' and 'site:' not in x]
 
-        results = [x for x in new_search_links if x != '#' and 'site:' not in x]
+        ''' Try domains that often had an ABV first and skip useless ones '''
+        if self.source_stats is not None:
+            results = self.source_stats.rank(results)
 
         ''' Max number of links to search for alcohol by volume (ABV) '''
         num_attempts = self.num_attempts
@@ -136,25 +296,144 @@ class BeerKeg(object):
                 r_it += 1
                 searched_domains.add(domain)
 
-        for i in xrange(min(num_attempts, len(top_results))):
+        ''' Race the first hedge pages, then go on with the rest in order '''
+        hedged = min(self.hedge, len(top_results))
+        if hedged > 1:
+            accepted, page_abvs = self.race_page_abvs(top_results[:hedged])
+            if accepted is not None:
+                self.count_attempts(hedged, accepted[1])
+                if self.verbose:
+                    print('ABV for {} is {}'.format(self.name, accepted[1]))
+                return accepted[1], accepted[0]
+            page_abvs = chain(page_abvs,
+                              self.iter_page_abvs(top_results[hedged:]))
+        else:
+            page_abvs = self.iter_page_abvs(top_results)
+
+        ''' Pages are only scanned as choose_abv asks for them '''
+        scanned = []
+        abv, url = self.choose_abv(scanned.append(x) or x for x in page_abvs)
+        if scanned and all(x[1] is PAGE_FAILED for x in scanned):
+            metrics.count('abv.pages_failed')
+            raise IOError('No candidate ABV page for {0} could be '
+                          'retrieved'.format(self.name))
+
+        self.count_attempts(len(scanned), abv)
+        return abv, url
+
+
+    def count_attempts(self, num_pages, abv):
+        ''' Records the number of pages scanned to resolve an ABV or not '''
+        if abv is None:
+            metrics.count('abv.unresolved')
+        else:
+            metrics.count('abv.resolved')
+            metrics.observe('abv.attempts', num_pages)
+
+
+    def scan_page(self, url, cancelled=None):
+        ''' Returns the ABV found on the page at url, or None if there is none
+
+            The page is streamed and scanning stops at the first ABV, after
+            max_scan_bytes or once cancelled is set. Raises IOError if the
+            page could not be retrieved
+        '''
+        scanner = TextScanner(ABV_PATTERN)
+        started = time.time()
+        try:
+            with metrics.timed('abv.page'):
+                abv = scan_url(url, max_bytes=self.max_scan_bytes,
+                               cancelled=cancelled, scanner=scanner)
+        except IOError:
+            if self.source_stats is not None:
+                self.source_stats.record(url, False, time.time() - started,
+                                         scanner.num_bytes, failed=True)
+            raise
+
+        ''' Pages cut short by a faster page say nothing about their domain '''
+        if self.source_stats is not None and \
+                (abv or cancelled is None or not cancelled.is_set()):
+            self.source_stats.record(url, bool(abv), time.time() - started,
+                                     scanner.num_bytes)
+
+        if abv:
+            abv = abv.group()
+
+            ''' Filters for a number with or without a decimal pt '''
+            return float(NUMBER_RE.search(abv).group())
+
+        return None
+
+
+    def iter_page_abvs(self, urls):
+        ''' Scans the pages at urls one at a time
+
+            Yields tuples of each url and its ABV, None if the page has no ABV
+            or PAGE_FAILED if the page could not be retrieved
+        '''
+        for url in urls:
             if self.verbose:
-                print('Searching {}'.format(top_results[i]))
+                print('Searching {}'.format(url))
 
             try:
-                search_text = ''.join(get_text(get_html(top_results[i])))
+                yield url, self.scan_page(url)
             except Exception:
-                continue
+                yield url, PAGE_FAILED
 
-            ''' Retrieves partial string containing the words ABV and a % '''
-            abv = re.search('(?<=[Aa][Bb][Vv])[^\d]*(\d+[.]?\d*)(?=%)|(?<=%)\
-                            [^\d]*(\d+[.]?\d*)[^\d]*\
-                            (?=[Aa][Bb][Cc])', search_text)
-            if abv:
-                abv = abv.group()
 
-                ''' Filters for a number with or without a decimal pt '''
-                abv = float(re.search('(\d+[.]?\d*)', abv).group())
+    def race_page_abvs(self, urls):
+        ''' Scans the pages at urls concurrently
 
+            Returns a tuple of the (url, ABV) of the first page to finish with
+            an ABV accepted without comparison, and the (url, ABV) of every
+            page in url order for the sequential rules if none was. Pages not
+            yet started are skipped once an ABV is accepted
+        '''
+        cancelled = threading.Event()
+        finished = Queue.Queue()
+
+        def scan(i, url):
+            if cancelled.is_set():
+                return
+            if self.verbose:
+                print('Searching {}'.format(url))
+
+            try:
+                abv = self.scan_page(url, cancelled)
+            except Exception:
+                abv = PAGE_FAILED
+            finished.put((i, abv))
+
+        pool = get_fetch_pool()
+        for i, url in enumerate(urls):
+            pool.apply_async(scan, (i, url))
+
+        page_abvs = [None] * len(urls)
+        for _ in xrange(len(urls)):
+            i, abv = finished.get()
+            page_abvs[i] = (urls[i], abv)
+
+            if abv is not PAGE_FAILED and abv is not None and \
+                    0.0 < abv < MAX_ABV / 2:
+                cancelled.set()
+                return page_abvs[i], None
+
+        return None, page_abvs
+
+
+    def choose_abv(self, page_abvs):
+        ''' Picks the ABV from (url, ABV) tuples given in search result order
+
+            Returns a tuple of the ABV and the url it was found on
+        '''
+        found_abv = ''
+        found_url = None
+
+        for url, abv in page_abvs:
+            if abv is PAGE_FAILED:
+                continue
+
+            if abv is not None:
                 ''' If new ABV is 0.0, return previously found ABV if any
                     otherwise, move onto the next link
                 '''
@@ -165,12 +444,12 @@ class BeerKeg(object):
                     else:
                         continue
 
-                if abv < max_abv:
-                    if abv < max_abv / 2:
+                if abv < MAX_ABV:
+                    if abv < MAX_ABV / 2:
                         if self.verbose:
                             print('ABV for {} is {}'.format(self.name, abv))
 
-                        return abv
+                        return abv, url
 
                     ''' Replace the new ABV only if the next is lower '''
                     if found_abv:
@@ -178,31 +457,38 @@ class BeerKeg(object):
                             if self.verbose:
                                 print('ABV for {} is {}'.format(self.name, abv))
 
-                            return abv
+                            return abv, url
                         else:
                             if self.verbose:
                                 print('ABV for {} is {}\
                                       '.format(self.name, found_abv))
 
-                            return found_abv
+                            return found_abv, found_url
 
                     ''' Sets the new ABV to the found ABV '''
                     found_abv = abv
+                    found_url = url
             else:
                 if found_abv:
                     if self.verbose:
                         print('ABV for {} is {}'.format(self.name, found_abv))
-                    return found_abv
+                    return found_abv, found_url
 
         ''' No ABV was found by this point '''
         if self.verbose:
             print('ABV not found for {}'.format(self.name))
 
-        return None
+        return None, None
 
 
     def get_ratio(self):
         ''' Returns the ratio of gallons of alcohol per USD '''
+        if not self.parsed:
+            self.parse()
+
+        if self.failed or not self.name:
+            return None
+
         alcohol_pct = self.get_abv()
         if alcohol_pct is not None:
             try:
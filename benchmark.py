@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+''' Benchmarks of the crawl, parse, extract, scan and rank hot paths
+
+    Each case runs in its own process so its peak memory is its own, and
+    reports its best wall time over the repeats, its throughput, its peak
+    resident memory and the objects it left allocated. Results can be saved
+    as a baseline and later runs compared against it
+'''
+
+import argparse
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+
+''' Share a case may get slower than its baseline before it is reported '''
+THRESHOLD = 0.1
+
+
+def get_peak_memory():
+    ''' Returns the peak resident memory in bytes of this process, or of the
+        largest process it started and waited for if that is larger
+    '''
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def bench_startup(size):
+    ''' Starts new interpreters that import choosemybeer, as every run from
+        cron or a worker pool does
+    '''
+    command = [sys.executable, '-c', 'import choosemybeer']
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def run():
+        for _ in range(size):
+            subprocess.check_call(command, cwd=cwd)
+        return size
+    return run
+
+
+def bench_parse(size):
+    ''' Parses keg detail pages and reads their fields with BeerKeg '''
+    from beerkeg import BeerKeg
+    from standin import SyntheticCatalog
+    from utils import parse_html
+
+    catalog = SyntheticCatalog(size)
+    pages = [catalog.render_keg(x) for x in range(size)]
+    keg = BeerKeg('', 0)
+
+    def run():
+        for page in pages:
+            keg.parse_html(parse_html(page))
+        return len(pages)
+    return run
+
+
+def bench_extract(size):
+    ''' Finds the ABV on large pages by parsing them, joining their text
+        with get_text and searching it with the ABV regex
+    '''
+    from standin import SyntheticCatalog
+    from utils import ABV_PATTERN, get_text, parse_html
+
+    catalog = SyntheticCatalog(size)
+    pages = [catalog.render_abv(3, x) for x in range(size)]
+
+    def run():
+        for page in pages:
+            text = ''.join(''.join(x) for x in get_text(parse_html(page)))
+            ABV_PATTERN.search(text)
+        return len(pages)
+    return run
+
+
+def bench_scan(size):
+    ''' Finds the ABV on large pages with the streaming TextScanner, as
+        candidate ABV pages are read
+    '''
+    from standin import SyntheticCatalog
+    from utils import ABV_PATTERN, TextScanner, scan_content
+
+    catalog = SyntheticCatalog(size)
+    pages = [catalog.render_abv(3, x) for x in range(size)]
+
+    def run():
+        for page in pages:
+            scan_content(TextScanner(ABV_PATTERN), page)
+        return len(pages)
+    return run
+
+
+def bench_rank(size):
+    ''' Keeps the top kegs of a large catalog with TopK and KegColumns '''
+    from columns import KegColumns
+    from ranker import TopK
+
+    rand = random.Random(0)
+    records = [{'beer_id': str(x), 'price': rand.uniform(50, 250),
+                'volume': rand.choice((5.16, 7.75, 13.2, 15.5)),
+                'abv': rand.uniform(3.5, 12.0), 'num_avail': rand.randint(0, 9)}
+               for x in range(size)]
+    scores = [x['abv'] * .1 * x['volume'] / x['price'] for x in records]
+
+    def run():
+        top = TopK(10)
+        for i, score in enumerate(scores):
+            top.push(score, i)
+        columns = KegColumns(records)
+        columns.top(10, 'alcohol', columns.select(200, 5))
+        return len(records)
+    return run
+
+
+def bench_crawl(size, latency=0.01):
+    ''' Crawls kegs from a stand-in server answering after latency seconds,
+        without the page cache so every page is fetched
+
+        Every run starts from an empty cache directory, which is removed
+        once the run is done
+    '''
+    import tempfile
+    import choosemybeer
+    import standin
+
+    server = standin.start(size, latency=latency)
+    parser = choosemybeer.get_parser()
+    cache_dir = tempfile.mkdtemp(prefix='choosemybeer-bench-')
+    args = vars(parser.parse_args(['--standin', server.get_url(),
+                                   '--cache-dir', cache_dir, '--no-cache',
+                                   '-l', str(size), '-w', '16', '-t', '3',
+                                   '-a', '10']))
+
+    def run():
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            choosemybeer.get_optimal_kegs(args)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        return size
+    return run
+
+
+''' Cases by name with the number of items each handles by default '''
+CASES = {'startup': (bench_startup, 10),
+         'parse': (bench_parse, 200),
+         'extract': (bench_extract, 100),
+         'scan': (bench_scan, 100),
+         'rank': (bench_rank, 100000),
+         'crawl': (bench_crawl, 200)}
+
+
+def run_case(name, size, repeat):
+    ''' Runs a case in this process, returns a dict of its results '''
+    bench, default_size = CASES[name]
+    size = size or default_size
+    run = bench(size)
+
+    best = None
+    objects = None
+    for _ in range(repeat):
+        gc.collect()
+        num_objects = len(gc.get_objects())
+        started = time.time()
+        num_items = run()
+        elapsed = time.time() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+        gc.collect()
+        objects = len(gc.get_objects()) - num_objects
+
+    return {'case': name, 'items': num_items, 'seconds': best,
+            'per_second': num_items / best if best else None,
+            'peak_memory': get_peak_memory(), 'objects': objects}
+
+
+def spawn_case(name, size, repeat):
+    ''' Runs a case in a new process, returns a dict of its results '''
+    command = [sys.executable, os.path.abspath(__file__), '--run-case', name,
+               '--repeat', str(repeat)]
+    if size:
+        command += ['--size', str(size)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    ''' Prints how each case changed from the baseline, returns the names of
+        cases that got slower by more than threshold
+    '''
+    slower = []
+    for name in sorted(results):
+        old = baseline.get(name)
+        if old is None:
+            continue
+
+        change = results[name]['seconds'] / old['seconds'] - 1
+        memory = results[name]['peak_memory'] / float(old['peak_memory']) - 1
+        print('{0:<8} time {1:+.1%}  peak memory {2:+.1%}'.format(name, change,
+                                                                  memory))
+        if change > threshold:
+            slower.append(name)
+    return slower
+
+
+def print_result(result):
+    print('{case:<8} {items:>7} items  {seconds:8.3f} s  {per_second:10.1f}/s'
+          '  {peak:7.1f} MiB peak  {objects:>7} objects'.format(
+              peak=result['peak_memory'] / 1048576.0, **result))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='benchmark the crawl, '
+                                                 'parse, extract, scan and '
+                                                 'rank hot paths')
+    parser.add_argument('cases', nargs='*',
+                        help='cases to run, of {0} (default: all)'.format(
+                            ', '.join(sorted(CASES))))
+    parser.add_argument('--size', type=int,
+                        help='number of items per case (default: per case)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the fastest is kept '
+                             '(default: 3)')
+    parser.add_argument('--save', type=str,
+                        help='save the results as a baseline to this file')
+    parser.add_argument('--compare', type=str,
+                        help='compare the results to the baseline in this '
+                             'file, exiting with 1 on a slowdown')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='share a case may slow down before it is a '
+                             'regression (default: 0.1)')
+    parser.add_argument('--run-case', type=str, help=argparse.SUPPRESS)
+    return parser
+
+
+def command_line_runner():
+    parser = get_parser()
+    args = vars(parser.parse_args())
+    unknown = set(args['cases']) - set(CASES)
+    if unknown:
+        parser.error('unknown cases: {0}'.format(', '.join(sorted(unknown))))
+
+    if args['run_case']:
+        print(json.dumps(run_case(args['run_case'], args['size'],
+                                  args['repeat'])))
+        return
+
+    results = {}
+    for name in args['cases'] or sorted(CASES):
+        results[name] = spawn_case(name, args['size'], args['repeat'])
+        print_result(results[name])
+
+    if args['save']:
+        with open(args['save'], 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+    if args['compare']:
+        with open(args['compare']) as baseline_file:
+            slower = compare(results, json.load(baseline_file),
+                             args['threshold'])
+        if slower:
+            print('Slower than the baseline: {0}'.format(', '.join(slower)))
+            sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    command_line_runner()
@@ -0,0 +1,123 @@
+import json
+import os
+import time
+
+from wordindex import WordIndex
+
+
+class Catalog(object):
+    ''' Snapshot of every crawled keg, keyed by BevMo beer id
+
+        Each record holds the fields of BeerKeg.to_dict plus the beer id and
+        the price the keg was listed at when it was crawled. The words of
+        every keg's name and description are kept in an inverted index
+    '''
+    def __init__(self, path=None, records=None, updated_at=None, index=None):
+        self.path = path
+        self.records = records if records is not None else {}
+        self.updated_at = updated_at
+
+        if index is None:
+            index = WordIndex()
+            for beer_id, record in self.records.items():
+                index.add(beer_id, record['name'], record['desc'])
+        self.index = index
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __contains__(self, beer_id):
+        return beer_id in self.records
+
+
+    @classmethod
+    def load(cls, path):
+        ''' Returns the catalog saved at path, or an empty one '''
+        if not os.path.exists(path):
+            return cls(path)
+
+        with open(path) as catalog_file:
+            data = json.load(catalog_file)
+
+        ''' Catalogs saved without an index have it rebuilt '''
+        index = data.get('index')
+        if index is not None:
+            index = WordIndex(index)
+        return cls(path, data['kegs'], data.get('updated_at'), index)
+
+
+    def save(self, path=None):
+        ''' Writes the catalog, replacing the old file only once written '''
+        path = path or self.path
+        self.updated_at = time.time()
+
+        tmp_path = '{0}.tmp'.format(path)
+        with open(tmp_path, 'w') as catalog_file:
+            json.dump({'updated_at': self.updated_at, 'kegs': self.records,
+                       'index': self.index.to_dict()}, catalog_file)
+        os.rename(tmp_path, path)
+
+
+    def add(self, beer_id, keg, listed_price=None):
+        ''' Records a parsed keg and the price it was listed at '''
+        record = keg.to_dict()
+        record['beer_id'] = beer_id
+        record['listed_price'] = listed_price
+        self.put(record)
+
+
+    def add_stub(self, stub):
+        ''' Records what the listing shows of a keg whose page was not
+            crawled, unless a record of it at that price is already saved
+
+            Stub records are marked unparsed, so their page is crawled by
+            the next incremental crawl or when their ABV is resolved
+        '''
+        if not self.is_changed(stub):
+            return
+
+        self.put({'beer_id': stub.beer_id, 'url': stub.url,
+                  'name': stub.name, 'volume': stub.volume,
+                  'price': stub.price, 'num_avail': None, 'desc': '',
+                  'abv': None, 'abv_resolved': False, 'ratio': None,
+                  'listed_price': stub.price, 'parsed': False})
+
+
+    def put(self, record):
+        ''' Records a keg's catalog record and indexes its words '''
+        self.records[record['beer_id']] = record
+        self.index.add(record['beer_id'], record['name'], record['desc'])
+
+
+    def is_changed(self, stub):
+        ''' Returns True if a listed keg is new, only known from a listing or
+            its listed price changed
+        '''
+        record = self.records.get(stub.beer_id)
+        if record is None or not record.get('parsed', True):
+            return True
+        return stub.price is not None and stub.price != record['listed_price']
+
+
+    def retain(self, beer_ids):
+        ''' Drops kegs that are no longer listed, returns how many '''
+        gone = [x for x in self.records if x not in beer_ids]
+        for beer_id in gone:
+            del self.records[beer_id]
+            self.index.remove(beer_id)
+        return len(gone)
+
+
+    def search(self, all_of=None, none_of=None):
+        ''' Returns the beer ids of kegs whose name or description has every
+            keyword of all_of and no keyword of none_of
+        '''
+        return self.index.query(all_of, none_of)
+
+
+    def iter_records(self):
+        ''' Yields records ordered by beer id so ranking ties are stable '''
+        for beer_id in sorted(self.records):
+            yield self.records[beer_id]
@@ -8,13 +8,42 @@
 #############################################################
 
 import argparse
-import heapq
-from urlparse import urlparse
-
-from beerkeg import BeerKeg
-from utils import get_html, is_num, unique
-
-import lxml.html as lh
+import errno
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import metrics
+from abvstore import AbvStore, SingleFlight
+from beerkeg import MAX_ABV, BeerKeg
+from catalog import Catalog
+from frontier import Frontier, get_beer_id, parse_listing
+from httpcache import HttpCache
+from output import WRITERS
+from ranker import SCORES, TopK, alcohol_per_dollar
+from sources import SourceStats
+from utils import (CACHE_DIR, MAX_CONNECTIONS, MAX_SCAN_BYTES, get_cache_path,
+                   get_html, get_html_async, set_fetch_limits,
+                   set_host_delay, set_http_cache, set_timeouts,
+                   set_transport)
+from wordindex import matches, tokenize
+from workqueue import WorkQueue, get_worker_name
+
+
+''' Seconds a queue worker waits for items leased by other workers '''
+POLL_SECONDS = 5
+
+''' ABV lookups kept for reuse by a streamed crawl, kegs of one beer are
+    listed close together
+'''
+STREAM_ABV_LOOKUPS = 1000
+
+''' Listing of BevMo beer kegs the crawl starts from '''
+SEED_URL = ('http://www.bevmo.com/Shop/ProductList.aspx/'
+            'Beer/Kegs/_/N-15Z1z141vn?DNID=Beer')
 
 
 def get_parser():
@@ -23,188 +52,842 @@ def get_parser():
     parser.add_argument('-a', '--attempts', type=int, nargs='?',
                         help='number of attempts to resolve each ABV '
                              '(default: 10)')
+    parser.add_argument('--cached', action='store_true',
+                        help='rank the kegs saved by the last crawl without '
+                             'crawling')
     parser.add_argument('-f', '--filter', type=str, nargs='*',
-                        help='find kegs with descriptions matching these '
-                             'keywords')
+                        help='find kegs whose name or description has all '
+                             'of these words, in any case')
+    parser.add_argument('--incremental', action='store_true',
+                        help='crawl only kegs that are new or changed in '
+                             'price since the last crawl, then rank every '
+                             'saved keg')
     parser.add_argument('-l', '--limit', type=int, nargs='?',
                         help='limit number of kegs to crawl (default: 10000)')
     parser.add_argument('-p', '--price', type=float, nargs='?',
                         help='limit the price range')
+    parser.add_argument('--min-volume', type=float,
+                        help='find kegs holding at least this many gallons')
+    parser.add_argument('--min-available', type=int,
+                        help='find kegs with at least this many in stock')
     parser.add_argument('-t', '--top', type=int, nargs='?',
                         help='number of top kegs to display (default: 3)')
+    parser.add_argument('-s', '--score', choices=sorted(SCORES),
+                        help='rank kegs by gallons of alcohol or of beer per '
+                             'USD (default: alcohol)')
     parser.add_argument('-u', '--unfilter', type=str, nargs='*',
-                        help='find kegs with descriptions not matching these '
-                             'keywords')
+                        help='find kegs whose name or description has none '
+                             'of these words, in any case')
+    parser.add_argument('-w', '--workers', type=int, nargs='?',
+                        help='number of kegs to evaluate concurrently '
+                             '(default: 1)')
+    parser.add_argument('--connections', type=int,
+                        help='max number of fetches in flight (default: 32)')
+    parser.add_argument('--host-connections', type=int,
+                        help='max number of fetches in flight per host '
+                             '(default: 8)')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds to wait on a stalled response '
+                             '(default: 30)')
+    parser.add_argument('--delay', type=float,
+                        help='min seconds between requests to one host '
+                             '(default: 0)')
+    parser.add_argument('--cache-dir', type=str,
+                        help='directory for cached pages (default: '
+                             '~/.choosemybeer, or ~/.choosemybeer/offline '
+                             'with --replay or --standin)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='fetch every page without the page cache')
+    parser.add_argument('--no-abv-cache', action='store_true',
+                        help='search for every ABV without the ABV store')
+    parser.add_argument('--refresh-abv', action='store_true',
+                        help='search for every ABV and update the ABV store')
+    parser.add_argument('--hedge', type=int,
+                        help='number of candidate ABV pages to fetch at once, '
+                             'taking the first with a plausible ABV '
+                             '(default: 1)')
+    parser.add_argument('--max-scan-bytes', type=int,
+                        help='bytes of a candidate ABV page to read before '
+                             'giving up on it (default: 524288)')
+    parser.add_argument('--metrics', type=str,
+                        help='save timings, byte counts and failures of the '
+                             'crawl to this JSON file')
+    parser.add_argument('--record', type=str,
+                        help='record every response into this fixture '
+                             'archive')
+    parser.add_argument('--replay', type=str,
+                        help='serve every request from this fixture archive '
+                             'without network access')
+    parser.add_argument('--standin', type=str,
+                        help='send every request to the stand-in server at '
+                             'this url, see standin.py')
+    parser.add_argument('--latency', type=float,
+                        help='seconds of latency to simulate per request')
+    parser.add_argument('--error-rate', type=float,
+                        help='share of requests to fail on purpose')
+    parser.add_argument('--queue', type=str,
+                        help='share the crawl with other processes through '
+                             'this queue file')
+    parser.add_argument('--role', choices=('coordinator', 'worker', 'merge'),
+                        help='seed, work and rank the queue, only work it or '
+                             'only rank its results (default: coordinator)')
+    parser.add_argument('--batch', type=int,
+                        help='number of queue items to claim at once '
+                             '(default: workers)')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='keep crawling in the background and answer '
+                             'queries over HTTP on this local port')
+    parser.add_argument('--refresh-every', type=float,
+                        help='seconds between background crawls with '
+                             '--serve (default: 3600)')
+    parser.add_argument('--output', choices=sorted(WRITERS),
+                        help='write every keg passing the filters as it is '
+                             'crawled, or the ranked kegs of --cached, '
+                             '--incremental or --queue, in this format '
+                             'instead of showing the menu')
+    parser.add_argument('--output-file', type=str,
+                        help='file to write --output to (default: stdout)')
     return parser
 
 
-def get_optimal_kegs(args):
-    ''' Gets kegs from bevmo.com
-        finds the kegs with the optimal gallons of alcohol per USD
+def listing_passes(stub, max_price, min_volume):
+    ''' Returns False if a keg's listed price or size fails the filters
+
+        Kegs whose listing doesn't show a price or size are kept
+    '''
+    if max_price and stub.price is not None and stub.price > max_price:
+        return False
+    if min_volume and stub.volume is not None and stub.volume < min_volume:
+        return False
+    return True
+
+
+def evaluate_keg(keg, max_price, min_volume, desc_filter, desc_unfilter,
+                 score=alcohol_per_dollar, min_avail=None):
+    ''' Filters a keg by price and description then scores it
+
+        Returns a tuple of whether the keg passed the filters and its score
+    '''
+    ''' Parse the keg once up front, which produces keg.desc, keg.price,
+        etc for the filters below
+    '''
+    keg.parse()
+
+    ''' Kegs whose page could not be retrieved are left for a later crawl '''
+    if keg.failed:
+        return False, None
+
+    ''' Check if price is within range if one was given '''
+    if max_price and keg.price > max_price:
+        return False, None
+
+    ''' Check if volume is large enough if a minimum was given '''
+    if min_volume and keg.volume < min_volume:
+        return False, None
+
+    ''' Check if enough kegs are available if a minimum was given '''
+    if min_avail and keg.num_avail < min_avail:
+        return False, None
+
+    ''' Kegs must have every word of desc_filter and no word of
+        desc_unfilter in their name or description
+    '''
+    if desc_filter or desc_unfilter:
+        words = tokenize(keg.name) | tokenize(keg.desc)
+        if not matches(words, desc_filter, desc_unfilter):
+            return False, None
+
+    ''' Gets the gallons of alcohol per USD for the keg by default '''
+    return True, score(keg)
+
+
+def get_cache_dir(args):
+    ''' Returns the cache directory in args
+
+        Crawls of replayed or stand-in pages default to their own directory
+        so they never mix with real pages, ABVs and kegs
+    '''
+    if args.get('cache_dir'):
+        return args['cache_dir']
+    if args.get('replay') or args.get('standin'):
+        return os.path.join(CACHE_DIR, 'offline')
+    return CACHE_DIR
+
+
+def setup_crawl(args, stream=False):
+    ''' Applies the fetch, cache and ABV options in args
+
+        Returns the keyword arguments for creating each BeerKeg of the crawl
+        and the catalog of earlier crawls. A streamed crawl gets no catalog
+        and shares only the latest ABV lookups, so all it holds per keg is
+        the id the listing walk skips repeats by
+    '''
+
+    set_fetch_limits(args.get('connections'), args.get('host_connections'))
+    set_timeouts(read_timeout=args.get('timeout'))
+    set_host_delay(args.get('delay'))
+
+    ''' Record or replay responses, or fetch them from a stand-in server,
+        the transport adapters are only imported when one is asked for
+    '''
+    transport = None
+    if any(args.get(x) for x in ('record', 'replay', 'standin', 'latency',
+                                 'error_rate')):
+        from replay import get_transport
+        transport = get_transport(args.get('record'), args.get('replay'),
+                                  args.get('standin'), args.get('latency'),
+                                  args.get('error_rate'),
+                                  args.get('connections') or MAX_CONNECTIONS)
+    set_transport(transport)
+
+    ''' Cache responses on disk so reruns avoid refetching pages, except when
+        every response has to reach or come from the fixture archive
+    '''
+    cache_dir = get_cache_dir(args)
+    if not (args.get('no_cache') or args.get('record') or
+            args.get('replay')):
+        set_http_cache(HttpCache(get_cache_path(cache_dir, 'http.sqlite')))
+
+    ''' Reuse ABVs resolved on earlier runs '''
+    abv_store = None
+    if not args.get('no_abv_cache'):
+        abv_store = AbvStore(get_cache_path(cache_dir, 'abv.sqlite'),
+                             refresh=args.get('refresh_abv'))
+
+    ''' Kegs of one beer in several sizes share a single ABV lookup '''
+    abv_lookups = SingleFlight(STREAM_ABV_LOOKUPS if stream else None)
+
+    ''' Learn which domains of search results usually have an ABV '''
+    source_stats = SourceStats(get_cache_path(cache_dir, 'sources.sqlite'))
+
+    keg_options = {'verbose': True, 'abv_store': abv_store,
+                   'abv_lookups': abv_lookups,
+                   'hedge': args.get('hedge') or 1,
+                   'max_scan_bytes': args.get('max_scan_bytes') or
+                   MAX_SCAN_BYTES,
+                   'source_stats': source_stats}
+
+    catalog = None
+    if not stream:
+        catalog = Catalog.load(get_cache_path(cache_dir, 'catalog.json'))
+    return keg_options, catalog
+
+
+def is_dominated(stub, top_kegs, score_keg):
+    ''' Returns True if a keg's listing shows it can't enter the top kegs '''
+    if score_keg is not alcohol_per_dollar:
+        return False
+
+    threshold = top_kegs.threshold()
+    max_ratio = stub.get_max_ratio()
+    return threshold is not None and max_ratio is not None and \
+        max_ratio <= threshold
+
+
+def get_keg_mapper(num_workers):
+    ''' Returns a map function for evaluating kegs and its pool, if any
+
+        Kegs are evaluated on a thread pool since each one is bound by the
+        latency of its detail page, search and ABV page fetches
+    '''
+    if num_workers > 1:
+        pool = ThreadPool(num_workers)
+        return pool.map, pool
+    return map, None
+
+
+def iter_listings(seed_url, failed_pages=None):
+    ''' Crawls the listing pages starting at seed_url
+
+        Yields the stubs of kegs not seen on an earlier page, one list per
+        page. Raises IOError if the seed page can't be retrieved, other
+        listing pages that can't be retrieved are skipped and appended to
+        failed_pages if given
+    '''
+    ''' Listing pages to crawl and kegs already found on them '''
+    frontier = Frontier([seed_url])
+
+    ''' Listing pages fetched in the background while kegs are evaluated '''
+    prefetched = {}
+
+    while frontier:
+        ''' Links are removed as they are crawled '''
+        page_link = frontier.pop_page()
+
+        with metrics.timed('listing.fetch'):
+            if page_link in prefetched:
+                page_html = prefetched.pop(page_link).get()
+            else:
+                page_html = get_html(page_link)
+
+        if page_html is None:
+            if page_link == seed_url:
+                raise IOError('Failed to retrieve {0}'.format(seed_url))
+            if failed_pages is not None:
+                failed_pages.append(page_link)
+            continue
+
+        ''' Keg stubs and further listing pages come from the same page '''
+        with metrics.timed('listing.parse'):
+            stubs, page_links = parse_listing(page_html, page_link)
+        for link in page_links:
+            frontier.add_page(link)
+
+        ''' Start fetching the next listing page before crawling this one '''
+        next_link = frontier.peek_page()
+        if next_link is not None and next_link not in prefetched:
+            prefetched[next_link] = get_html_async(next_link)
+
+        ''' Cache the BevMo beer id's to prevent duplicates '''
+        yield [x for x in stubs if frontier.add_beer(x.beer_id)]
+
+
+def iter_optimal_kegs(args, crawl=None, prune=True):
+    ''' Gets kegs from bevmo.com, yielding a (score, keg) tuple for every
+        keg passing the filters as soon as it is scored, in listing order
+
+        Kegs whose listing shows they can't beat the top kegs scored so far
+        are skipped unless prune is False. crawl is the keg options and
+        catalog returned by an earlier setup_crawl, to reuse them, kegs are
+        not saved if it has no catalog. Raises IOError if the seed listing
+        page can't be retrieved
     '''
     num_kegs = args['top']
     beer_limit = args['limit']
-    num_attempts = args['attempts']
     max_price = args['price']
+    min_volume = args.get('min_volume')
+    min_avail = args.get('min_available')
+    score_keg = SCORES[args.get('score') or 'alcohol']
     desc_filter = args['filter']
     desc_unfilter = args['unfilter']
+    num_attempts = args['attempts']
+    num_workers = args.get('workers') or 1
 
-    ''' The first url to crawl and its base url '''
-    seed_url = 'http://www.bevmo.com/Shop/ProductList.aspx/\
-                Beer/Kegs/_/N-15Z1z141vn?DNID=Beer'
-    base_url = '{url.scheme}://{url.netloc}'.format(url=urlparse(seed_url))
+    keg_options, catalog = crawl or setup_crawl(args)
+    abv_lookups = keg_options['abv_lookups']
 
-    ''' Get initial unique page links from the seed url
-        append base_url to them
+    ''' Number of crawled beer kegs that passed the filters, the listing
+        walk already skips beers seen before
     '''
+    num_crawled = 0
+
+    ''' Holds the top beer kegs, for skipping kegs that can't enter them '''
+    top_kegs = TopK(num_kegs)
 
-    '''     For info on XPaths, see:
-            http://www.w3schools.com/xpath/xpath_syntax.asp
+    ''' Kegs are evaluated on a thread pool since each one is bound by the
+        latency of its detail page, search and ABV page fetches
     '''
-    init_page_links = []
-    init_page_links[:] = unique(get_html(seed_url).xpath('//div[@class="Product\
-                                                         ListPaging"]/a/@href'))
+    pool = ThreadPool(num_workers) if num_workers > 1 else None
+
+    def submit(keg):
+        ''' Starts evaluating a keg, returns a function waiting on it '''
+        evaluate_args = (keg, max_price, min_volume, desc_filter,
+                         desc_unfilter, score_keg, min_avail)
+        if pool is None:
+            return partial(evaluate_keg, *evaluate_args)
+        return pool.apply_async(evaluate_keg, evaluate_args).get
+
+    ''' Kegs skipped using only their listing '''
+    num_prefiltered = 0
+    num_dominated = 0
+
+    ''' Listed kegs not yet submitted, and submitted kegs in listing order '''
+    listed = deque()
+    pending = deque()
+
+    listings = iter_listings(SEED_URL)
+    try:
+        while num_crawled < beer_limit:
+            ''' Keep num_workers kegs in flight across listing pages. Results
+                are consumed in listing order and checked against the top
+                kegs again, so the limit, dedup and ranking match a
+                sequential crawl, and results past the limit are dropped
+            '''
+            while listings is not None and len(pending) < num_workers:
+                if not listed:
+                    try:
+                        listed.extend(next(listings))
+                    except StopIteration:
+                        listings = None
+                    continue
+
+                stub = listed.popleft()
+
+                ''' Reject kegs by their listed price and size before
+                    fetching their pages, keeping their listing in the
+                    catalog for other queries
+                '''
+                if not listing_passes(stub, max_price, min_volume):
+                    num_prefiltered += 1
+                    if catalog is not None:
+                        catalog.add_stub(stub)
+                    continue
+
+                ''' Once the top kegs are full, kegs whose best possible
+                    ratio can't beat the lowest of them are skipped. The
+                    threshold only rises, so a sequential crawl would have
+                    skipped them too
+                '''
+                if prune and is_dominated(stub, top_kegs, score_keg):
+                    num_dominated += 1
+                    if catalog is not None:
+                        catalog.add_stub(stub)
+                    continue
+
+                ''' Create BeerKeg object and start evaluating it '''
+                keg = BeerKeg(stub.url, num_attempts, **keg_options)
+                pending.append((stub, keg, submit(keg)))
 
-    if not init_page_links:
+            if not pending:
+                break
+
+            stub, keg, get_result = pending.popleft()
+            started = time.time()
+            accepted, score = get_result()
+            metrics.observe('crawl.wait', time.time() - started)
+            metrics.count('kegs.evaluated')
+
+            ''' Every parsed keg is saved, whether or not it passed this
+                crawl's filters
+            '''
+            if catalog is not None and not keg.failed:
+                catalog.add(stub.beer_id, keg, stub.price)
+
+            if not accepted:
+                ''' Move onto the next keg and ignore this one '''
+                continue
+
+            ''' Kegs outranked by the kegs consumed since they were
+                submitted are skipped as a sequential crawl would
+            '''
+            if prune and is_dominated(stub, top_kegs, score_keg):
+                num_dominated += 1
+                continue
+
+            ''' Count current beer as crawled '''
+            num_crawled += 1
+            metrics.count('kegs.accepted')
+
+            ''' Print how many kegs have been crawled '''
+            print('Keg {}'.format(num_crawled))
+            print('')
+
+            top_kegs.push(score, keg)
+            yield score, keg
+    finally:
+        ''' Runs once the crawl is done or its consumer stops early '''
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        if catalog is not None:
+            catalog.save()
+        keg_options['source_stats'].flush()
+
+        metrics.count('kegs.prefiltered', num_prefiltered)
+        metrics.count('kegs.dominated', num_dominated)
+        metrics.count('abv.lookups_saved', abv_lookups.saved)
+        if num_prefiltered or num_dominated:
+            print('Skipped {} kegs filtered and {} kegs outranked by their '
+                  'listing'.format(num_prefiltered, num_dominated))
+
+        if abv_lookups.saved:
+            print('Saved {} duplicate ABV lookups'.format(abv_lookups.saved))
+
+
+def get_optimal_kegs(args, on_update=None, crawl=None):
+    ''' Gets kegs from bevmo.com
+        finds the kegs with the optimal gallons of alcohol per USD
+
+        on_update is called with the (score, keg) tuples of the top kegs
+        whenever they change during the crawl. crawl is the keg options and
+        catalog returned by an earlier setup_crawl, to reuse them
+    '''
+    ''' Holds the top beer kegs, limited to the num_kegs argument '''
+    top_kegs = TopK(args['top'], on_update)
+
+    try:
+        for score, keg in iter_optimal_kegs(args, crawl):
+            ''' Keep the current top kegs ranked by their score '''
+            top_kegs.push(score, keg)
+    except IOError:
         print('Failed to retrieve the initial keg page links!')
         return None
 
-    ''' Lists for holding links to pages of beer kegs '''
-    page_links = [seed_url] + map(lambda x: base_url + x, init_page_links)
-    new_page_links = []
+    if top_kegs.num_missing:
+        print('Could not score {} kegs'.format(top_kegs.num_missing))
 
-    ''' Lists for holding links to individual beer kegs '''
-    beer_links = []
-    new_beer_links = []
+    ''' (score, keg) tuples in descending order by score '''
+    return top_kegs.snapshot()
 
-    ''' To keep track of already crawled beer kegs '''
-    crawled_beers = set()
 
-    ''' List for matching --filter and --unfilter keyword arguments to
-        keg descriptions
+def refresh_keg(keg):
+    ''' Parses a keg and resolves its ratio, returns False if that failed '''
+    try:
+        keg.parse()
+        if keg.failed:
+            return False
+        keg.get_ratio()
+        return True
+    except Exception:
+        return False
+
+
+def get_incremental_kegs(args, on_update=None, crawl=None):
+    ''' Walks only the listing pages and crawls the kegs that are new or
+        listed at a new price since the saved catalog, then ranks the
+        updated catalog
+
+        Takes the same args and returns the same tuples as get_optimal_kegs
     '''
-    matched = []
+    beer_limit = args['limit']
+    num_workers = args.get('workers') or 1
 
-    ''' List to hold top beer kegs, the size of optimal_kegs is limited by the
-        num_kegs argument
+    keg_options, catalog = crawl or setup_crawl(args)
+
+    ''' Every listed keg by beer id, in listing order '''
+    listed = OrderedDict()
+    failed_pages = []
+    try:
+        for stubs in iter_listings(SEED_URL, failed_pages):
+            for stub in stubs:
+                listed[stub.beer_id] = stub
+    except IOError:
+        print('Failed to retrieve the initial keg page links!')
+        return None
+
+    changed = [x for x in listed.values() if catalog.is_changed(x)]
+    changed = changed[:beer_limit]
+    kegs = [BeerKeg(x.url, args['attempts'], **keg_options) for x in changed]
+
+    map_kegs, pool = get_keg_mapper(num_workers)
+    refreshed = map_kegs(refresh_keg, kegs)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    keg_options['source_stats'].flush()
+
+    num_updated = 0
+    for stub, keg, ok in zip(changed, kegs, refreshed):
+        if ok:
+            catalog.add(stub.beer_id, keg, stub.price)
+            num_updated += 1
+
+    ''' Kegs are only removed once every listing page was walked, since
+        the kegs of a page that failed are still listed
     '''
-    optimal_kegs = []
+    num_removed = 0
+    if failed_pages:
+        print('Kept unlisted kegs, {} listing pages failed'.format(
+            len(failed_pages)))
+    else:
+        num_removed = catalog.retain(listed)
+    catalog.save()
 
-    keg = None
-    while len(page_links) > 0 and len(crawled_beers) < beer_limit:
-        ''' Links are removed as they are crawled '''
-        page_link = page_links.pop(0)
+    print('Updated {} kegs, removed {} kegs, {} kegs in catalog'.format(
+        num_updated, num_removed, len(catalog)))
+
+    return rank_catalog(catalog, args, keg_options, on_update)
+
+
+def get_cached_kegs(args, on_update=None):
+    ''' Ranks the kegs saved by earlier crawls without fetching any page
+
+        Kegs whose ABV was never resolved are left unranked by alcohol
+    '''
+    cache_dir = get_cache_dir(args)
+    catalog = Catalog.load(get_cache_path(cache_dir, 'catalog.json'))
+    if not catalog:
+        print('No saved kegs in {}, run a crawl first'.format(cache_dir))
+        return []
 
-        ''' Beer keg links '''
-        new_beer_links[:] = unique(get_html(page_link).xpath('//a[@class="Prod\
-                                                             uctListItemLink"]\
-                                                             /@href'))
-        beer_links += [base_url + x for x in new_beer_links]
+    return rank_catalog(catalog, args, on_update=on_update)
 
-        ''' Crawl the beer keg links
-            get the gallons of alcohol/USD ratio
+
+def resolve_catalog_abvs(catalog, columns, rows, args, keg_options):
+    ''' Resolves the ABVs of saved kegs that an earlier crawl never needed
+        or did not find, out of the rows of columns a query kept, returns the
+        number of kegs updated
+
+        ABVs not found are asked of the ABV store again, which only searches
+        for them once their negative record expired
+
+        Kegs whose listing shows they can't reach the top kegs already
+        resolved are skipped, and at most --limit kegs are looked up, those
+        that could score highest first
+    '''
+    resolved = columns.top(args['top'], 'alcohol', rows)
+    threshold = None
+    if len(resolved) == args['top']:
+        threshold = resolved[-1][0]
+
+    candidates = []
+    for row in rows:
+        record = columns.records[row]
+        if record['abv'] is not None or (record['abv_resolved'] and
+                                         keg_options['abv_store'] is None):
+            continue
+
+        ''' Ties keep the lower row first, so only kegs that can't even
+            reach the threshold are skipped
         '''
-        for link in beer_links:
-            ''' Break if the number of crawled beers exceeds the limit '''
-            if len(crawled_beers) >= beer_limit:
-                break
+        max_ratio = None
+        if record['price'] and record['volume'] is not None:
+            max_ratio = (MAX_ABV * .1 * record['volume']) / record['price']
+        if threshold is not None and max_ratio is not None and \
+                max_ratio < threshold:
+            continue
+        candidates.append((max_ratio is None, -(max_ratio or 0), row))
+
+    records = [columns.records[x[2]]
+               for x in sorted(candidates)[:args['limit']]]
+
+    kegs = [BeerKeg.from_dict(x, args['attempts'], **keg_options)
+            for x in records]
+    for keg in kegs:
+        keg.abv_resolved = False
+
+    map_kegs, pool = get_keg_mapper(args.get('workers') or 1)
+    refreshed = map_kegs(refresh_keg, kegs)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    num_updated = 0
+    for record, keg, ok in zip(records, kegs, refreshed):
+        if ok:
+            catalog.add(record['beer_id'], keg, record['listed_price'])
+            num_updated += 1
+    return num_updated
+
+
+def rank_catalog(catalog, args, keg_options=None, on_update=None):
+    ''' Ranks the kegs saved in a catalog by the filters and score in args
+
+        Keyword filters run over the catalog's word index, and price, volume
+        and availability filters and the ranking over its columns.
+        keg_options are passed to each restored BeerKeg, and resolve the
+        ABVs of kegs passing the filters that were never needed by an
+        earlier crawl
+
+        Returns (score, keg) tuples in descending order by score
+    '''
+    score = args.get('score') or 'alcohol'
 
-            ''' Cache the BevMo beer id's to prevent duplicates '''
-            beer_id = link.split('/')[-1]
+    ''' Keyword filters are answered by the catalog's word index '''
+    beer_ids = None
+    if args['filter'] or args['unfilter']:
+        beer_ids = catalog.search(args['filter'], args['unfilter'])
 
-            if beer_id not in crawled_beers:
-                ''' Create BeerKeg object '''
-                keg = BeerKeg(link, num_attempts, verbose=True)
+    ''' NumPy is only imported by processes that rank a catalog '''
+    from columns import KegColumns
 
-                ''' Call keg.parse() then filter kegs by their descriptions
-                    Calling keg.parse() produces fields keg.desc, keg.price, etc
-                    keg.parse() will only parse once per keg object
-                '''
+    def select(columns):
+        return columns.select(args['price'], args.get('min_volume'),
+                              args.get('min_available'), beer_ids)
 
-                ''' Check if price is within range if one was given '''
-                if max_price:
-                    keg.parse()
+    columns = KegColumns.from_catalog(catalog)
+    rows = select(columns)
 
-                    if keg.price > max_price:
-                        ''' Move onto the next keg and ignore this one '''
-                        continue
+    if score == 'alcohol' and keg_options is not None:
+        ''' Resolved ABVs are saved for later runs and service refreshes.
+            Parsing kegs only known from a listing may change their fields,
+            so the kegs are selected again
+        '''
+        if resolve_catalog_abvs(catalog, columns, rows, args, keg_options):
+            if catalog.path:
+                catalog.save()
+            columns = KegColumns.from_catalog(catalog)
+            rows = select(columns)
+        keg_options['source_stats'].flush()
+
+    top_kegs = [(value, BeerKeg.from_dict(columns.records[row],
+                                          args['attempts'],
+                                          **(keg_options or {})))
+                for value, row in columns.top(args['top'], score, rows)]
+
+    if on_update is not None:
+        on_update(top_kegs)
+    return top_kegs
+
+
+def refresh_catalog(args, crawl):
+    ''' Crawls into the catalog of crawl, in full the first time and then
+        only the kegs that are new or changed
+
+        The crawl keeps its caches, so pages and ABVs stored by earlier
+        refreshes stay warm, while ABV lookups are shared only within a
+        refresh so stored ABVs expire as usual. Returns a copy of the
+        updated catalog that the crawl never changes
+    '''
+    keg_options, catalog = crawl
+    crawl = (dict(keg_options, abv_lookups=SingleFlight()), catalog)
+
+    if catalog:
+        if get_incremental_kegs(args, crawl=crawl) is None:
+            raise IOError('Failed to retrieve the initial keg page links')
+    else:
+        ''' The first crawl keeps every keg, not only those ranked by the
+            options the service was started with
+        '''
+        for _ in iter_optimal_kegs(args, crawl, prune=False):
+            pass
 
-                ''' args['filter'] has words that must be in the description '''
-                ''' desc_filter has words that must be in the description '''
-                if desc_filter:
-                    keg.parse()
+    if args['metrics']:
+        metrics.save(args['metrics'])
 
-                    matched = [word in keg.desc for word in desc_filter]
+    return Catalog.load(catalog.path)
 
-                    ''' All keywords must be present for a match '''
-                    if not all(matched):
-                        ''' Move onto the next keg and ignore this one '''
-                        continue
 
-                ''' desc_unfilter has words that can't be in the description '''
-                if desc_unfilter:
-                    keg.parse()
+def run_service(args):
+    ''' Answers ranking queries over HTTP while refreshing the catalog every
+        --refresh-every seconds, starting from the saved catalog
+    '''
+    from service import REFRESH_SECONDS, QueryService, serve
 
-                    matched = [word in keg.desc for word in desc_unfilter]
+    crawl = setup_crawl(args)
+    service = QueryService(lambda: refresh_catalog(args, crawl),
+                           Catalog.load(crawl[1].path))
+    serve(service, args['serve'], args.get('refresh_every') or
+          REFRESH_SECONDS)
 
-                    ''' Any keyword must be present to nullify a match '''
-                    if any(matched):
-                        ''' Move onto the next keg and ignore this one '''
-                        continue
 
-                ''' Add current beer to crawled beers '''
-                crawled_beers.add(beer_id)
+def process_item(item, num_attempts, keg_options):
+    ''' Crawls a listing page or keg claimed from a work queue
 
-                ''' Print how many kegs have been crawled '''
-                print('Keg {}'.format(len(crawled_beers)))
+        Returns the stubs and paging links of a listing page, the catalog
+        record of a keg, or None if the item failed
+    '''
+    if item.kind == 'listing':
+        page_html = get_html(item.url)
+        if page_html is None:
+            return None
+        return parse_listing(page_html, item.url)
+
+    keg = BeerKeg(item.url, num_attempts, **keg_options)
+    if not refresh_keg(keg):
+        return None
 
-                ''' Gets the gallons of alcohol per USD for the keg '''
-                ratio = keg.get_ratio()
+    record = keg.to_dict()
+    record['beer_id'] = get_beer_id(item.url)
+    record['listed_price'] = (item.data or {}).get('listed_price')
+    return record
 
-                print('')
 
-                ''' Maintain a sorted list of the current top 3 kegs using
-                    heapq (heap queue algorithm)
+def run_worker(args, queue, crawl):
+    ''' Claims batches of listing pages and kegs from the queue and crawls
+        them until no item is pending or leased by another worker
 
-                    optimal_kegs holds a tuple containing the ratio and keg
-                    associated with it
-                '''
-                if optimal_kegs:
-                    for opt_tuple in optimal_kegs:
-                        ''' If ratio is greater than any keg ratio currently
-                            in optimal_kegs, then add it
-                        '''
-                        if ratio > opt_tuple[0]:
-                            if len(optimal_kegs) >= num_kegs:
-                                ''' Adds new item to list
-                                    removes the smallest to maintain size
-                                '''
-                                heapq.heappushpop(optimal_kegs, (ratio, keg))
-                            else:
-                                heapq.heappush(optimal_kegs, (ratio, keg))
-                            break
-                else:
-                    ''' Will only occur for the very first keg crawled '''
-                    heapq.heappush(optimal_kegs, (ratio, keg))
-
-        ''' Typical link: Shop/ProductList.aspx/_/N-15Z1z141vn/No-100?DNID=Beer
-
-            If No- is evenly divisible by 100, it leads to more pages to add
+        crawl is the keg options and catalog returned by setup_crawl
+    '''
+    beer_limit = args['limit']
+    num_attempts = args['attempts']
+    num_workers = args.get('workers') or 1
+    batch_size = args.get('batch') or num_workers
+
+    keg_options = crawl[0]
+    map_kegs, pool = get_keg_mapper(num_workers)
+    owner = get_worker_name()
+
+    ''' Kegs this worker finished '''
+    num_done = 0
+
+    while True:
+        items = queue.claim(owner, batch_size)
+        if not items:
+            if queue.is_drained():
+                break
+
+            ''' Other workers hold the remaining items, they are reclaimed
+                here if their leases run out
+            '''
+            time.sleep(POLL_SECONDS)
+            continue
+
+        results = map_kegs(lambda x: process_item(x, num_attempts,
+                                                  keg_options), items)
+
+        ''' Only this thread touches the queue, each listing's links and
+            kegs are queued in one transaction
         '''
-        if 'No-' in page_link:
-            if int(page_link.split('No-')[1].split('?')[0]) % 100 == 0:
-                ''' Unique new page links with their base url appended '''
-                new_page_links[:] = unique(get_html(page_link).xpath('//div[@cl\
-                                                                     ass="Produ\
-                                                                     ctListPagi\
-                                                                     ng"]/a/@hr\
-                                                                     ef'))
-                page_links += [base_url + x for x in new_page_links]
-
-    ''' Sort the list in descending order by ratio
-        (index 0 in the keg tuple)
+        for item, result in zip(items, results):
+            if result is None:
+                queue.release(item)
+            elif item.kind == 'listing':
+                stubs, page_links = result
+                queue.put_many('listing', [(x, None) for x in page_links])
+                queue.put_many('keg', [(x.url, {'listed_price': x.price})
+                                       for x in stubs], beer_limit)
+                queue.complete(item)
+            else:
+                queue.put_result(result['beer_id'], result)
+                queue.complete(item)
+                num_done += 1
+                print('Keg {}: {}'.format(num_done, result['name']))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    keg_options['source_stats'].flush()
+
+
+def merge_results(args, queue, crawl):
+    ''' Saves the kegs crawled through the queue to the catalog and ranks them
+
+        crawl is the keg options and catalog returned by setup_crawl. Returns
+        (score, keg) tuples in descending order by score
     '''
-    return sorted(optimal_kegs, key=lambda x: x[0], reverse=True)
+    keg_options, catalog = crawl
+
+    results = queue.get_results()
+    for record in results.values():
+        catalog.put(record)
+    catalog.save()
+
+    num_failed = queue.count(states=('failed',))
+    print('Merged {} kegs, {} items failed'.format(len(results), num_failed))
+
+    return rank_catalog(Catalog(records=results), args, keg_options)
+
+
+def run_queue(args):
+    ''' Runs one role of a crawl shared through the work queue in args
+
+        The coordinator queues the seed page, works alongside any other
+        workers until the queue is drained and merges the results
+    '''
+    queue = WorkQueue(args['queue'])
+    role = args.get('role') or 'coordinator'
+
+    ''' Every role shares one set of caches and keg options '''
+    crawl = setup_crawl(args)
+
+    if role == 'coordinator':
+        queue.put('listing', SEED_URL)
+    if role in ('coordinator', 'worker'):
+        run_worker(args, queue, crawl)
+    if role in ('coordinator', 'merge'):
+        return merge_results(args, queue, crawl)
+    return None
+
+
+def write_output(scored_kegs, kind, out):
+    ''' Writes (score, keg) tuples to out in an output format as they come
+
+        A crawl failing before any keg, or a reader closing the pipe, ends
+        the output with a message rather than a traceback
+    '''
+    try:
+        num_written = WRITERS[kind](scored_kegs, out)
+    except IOError as err:
+        if err.errno == errno.EPIPE:
+            return
+        if err.errno is not None:
+            raise
+        print('Failed to retrieve the initial keg page links!')
+        return
+
+    print('Wrote {} kegs'.format(num_written))
 
 
 def command_line_runner():
@@ -223,7 +906,46 @@ def command_line_runner():
     if not args['attempts']:
         args['attempts'] = 10
 
-    optimal_kegs = get_optimal_kegs(args)
+    ''' Number of kegs to evaluate concurrently (default: 1) '''
+    if not args['workers']:
+        args['workers'] = 1
+
+    if args['metrics']:
+        metrics.enable()
+
+    ''' Progress goes to stderr so records can stream to stdout '''
+    out = None
+    if args['output']:
+        out = open(args['output_file'], 'w') if args['output_file'] \
+            else sys.stdout
+        sys.stdout = sys.stderr
+
+    if args['serve'] is not None:
+        run_service(args)
+        return
+
+    if args['queue']:
+        optimal_kegs = run_queue(args)
+    elif args['cached']:
+        optimal_kegs = get_cached_kegs(args)
+    elif args['incremental']:
+        optimal_kegs = get_incremental_kegs(args)
+    elif args['output']:
+        optimal_kegs = iter_optimal_kegs(args, setup_crawl(args, stream=True),
+                                         prune=False)
+    else:
+        optimal_kegs = get_optimal_kegs(args)
+
+    if args['output']:
+        write_output(optimal_kegs or [], args['output'], out)
+        if args['output_file']:
+            out.close()
+
+    if args['metrics']:
+        metrics.save(args['metrics'])
+
+    if args['output'] or (args['queue'] and args['role'] == 'worker'):
+        return
 
     ratio = 0
     keg = None
@@ -0,0 +1,134 @@
+import heapq
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NAN = float('nan')
+
+
+class KegColumns(object):
+    ''' Column per field view of catalog records for fast filtering and
+        ranking
+
+        Numeric fields are held in contiguous float arrays, NumPy arrays when
+        NumPy is installed and array module arrays otherwise. Missing values
+        are NaN, and a keg is identified by its row index
+    '''
+    NUMERIC_FIELDS = ('price', 'volume', 'abv', 'num_avail')
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.beer_ids = [x['beer_id'] for x in self.records]
+
+        for field in self.NUMERIC_FIELDS:
+            values = array('d', (NAN if x.get(field) is None
+                                 else float(x[field]) for x in self.records))
+            if numpy is not None:
+                values = numpy.frombuffer(values, dtype=numpy.float64)
+            setattr(self, field, values)
+
+        ''' Gallons of alcohol per USD, NaN without an ABV or price '''
+        self.ratio = self.divide(self.scale(self.abv, self.volume, .1),
+                                 self.price)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        return cls(catalog.iter_records())
+
+
+    @staticmethod
+    def scale(left, right, factor=1.0):
+        ''' Returns the product of two columns and a factor '''
+        if numpy is not None:
+            return left * right * factor
+        return array('d', (x * y * factor for x, y in zip(left, right)))
+
+
+    @staticmethod
+    def divide(left, right):
+        ''' Returns left over right, NaN where either is missing or negative
+            or right is zero
+        '''
+        if numpy is not None:
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return numpy.where((right > 0) & (left >= 0), left / right,
+                                   NAN)
+        return array('d', (x / y if y > 0 and x >= 0 else NAN
+                           for x, y in zip(left, right)))
+
+
+    def get_scores(self, score):
+        ''' Returns the column a score ranks by, higher is better '''
+        if score == 'alcohol':
+            return self.ratio
+        if score == 'volume':
+            return self.divide(self.volume, self.price)
+        raise ValueError('Unknown score {0}'.format(score))
+
+
+    def select(self, max_price=None, min_volume=None, min_avail=None,
+               beer_ids=None):
+        ''' Returns the row indices of kegs passing the filters, out of the
+            kegs in beer_ids if given
+        '''
+        if numpy is not None:
+            if beer_ids is None:
+                mask = numpy.ones(len(self), dtype=bool)
+            else:
+                mask = numpy.zeros(len(self), dtype=bool)
+                mask[[i for i, x in enumerate(self.beer_ids)
+                      if x in beer_ids]] = True
+
+            ''' Comparisons with NaN are False, so missing values pass '''
+            with numpy.errstate(invalid='ignore'):
+                if max_price:
+                    mask &= ~(self.price > max_price)
+                if min_volume:
+                    mask &= ~(self.volume < min_volume)
+                if min_avail:
+                    mask &= ~(self.num_avail < min_avail)
+            return numpy.flatnonzero(mask)
+
+        return [i for i in xrange(len(self))
+                if (beer_ids is None or self.beer_ids[i] in beer_ids)
+                and not (max_price and self.price[i] > max_price)
+                and not (min_volume and self.volume[i] < min_volume)
+                and not (min_avail and self.num_avail[i] < min_avail)]
+
+
+    def top(self, k, score='alcohol', rows=None):
+        ''' Returns the (score, row) tuples of the k highest scoring rows
+
+            Rows without a score are left out, and ties keep the lower row
+            first
+        '''
+        scores = self.get_scores(score)
+        if rows is None:
+            rows = xrange(len(self)) if numpy is None else \
+                numpy.arange(len(self))
+
+        if numpy is not None:
+            rows = numpy.asarray(rows, dtype=numpy.intp)
+            rows = rows[~numpy.isnan(scores[rows])]
+            if len(rows) > k > 0:
+                ''' Partition out the kth best score and keep every row
+                    reaching it, ties included, before sorting only those
+                '''
+                kth = len(rows) - k
+                kth = numpy.partition(scores[rows], kth)[kth]
+                rows = rows[scores[rows] >= kth]
+            order = numpy.lexsort((rows, -scores[rows]))[:k]
+            return [(float(scores[x]), int(x)) for x in rows[order]]
+
+        candidates = ((scores[x], -x) for x in rows
+                      if scores[x] == scores[x])
+        return [(value, -x) for value, x in heapq.nlargest(k, candidates)]
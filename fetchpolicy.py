@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+
+
+''' Statuses of an overloaded or briefly unavailable server, worth retrying '''
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+''' Statuses asking the client to slow down '''
+THROTTLE_STATUSES = frozenset([429, 503])
+
+''' Times a failed request is retried, waiting a random time of up to
+    BACKOFF_BASE seconds doubled per retry and at most BACKOFF_MAX
+'''
+MAX_RETRIES = 2
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+
+''' Failures in a row after which a host is skipped, and seconds before one
+    request is let through to see if it recovered
+'''
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 60.0
+
+''' Seconds a response may take before it counts against its host '''
+LATENCY_BUDGET = 15.0
+
+
+def get_backoff(retry, retry_after=None):
+    ''' Returns the seconds to wait before a retry, numbered from 0
+
+        A Retry-After header given in seconds is honored up to BACKOFF_MAX
+    '''
+    try:
+        return min(float(retry_after), BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** retry))
+
+
+def is_failure(status_code):
+    ''' Returns True if a response status means the server failed '''
+    return status_code in RETRY_STATUSES or status_code >= 500
+
+
+class HostLimit(object):
+    ''' Limits the fetches in flight to one host and breaks the circuit to a
+        host that keeps failing
+
+        Used as a context manager around a fetch. The limit starts at
+        max_slots, is halved whenever the host throttles a request and grows
+        back by one after as many successes in a row as the limit. After
+        BREAKER_FAILURES failures or overly slow responses in a row the host
+        is skipped for BREAKER_COOLDOWN seconds, then a single request probes
+        it and either closes the circuit or opens it again
+    '''
+    def __init__(self, max_slots):
+        self.cond = threading.Condition()
+        self.max_slots = max_slots
+        self.limit = max_slots
+        self.in_flight = 0
+        self.successes = 0
+        self.failures = 0
+
+        ''' When the circuit was opened, None while it is closed '''
+        self.opened_at = None
+        self.probing = False
+
+
+    def __enter__(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+        return self
+
+
+    def __exit__(self, *exc_info):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+        return False
+
+
+    def allow(self):
+        ''' Returns False if requests to the host should be skipped '''
+        with self.cond:
+            if self.opened_at is None:
+                return True
+            if self.probing or \
+                    time.time() - self.opened_at < BREAKER_COOLDOWN:
+                return False
+            self.probing = True
+            return True
+
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+    def record_success(self, latency):
+        ''' Records a request the host answered in latency seconds '''
+        if latency > LATENCY_BUDGET:
+            self.record_failure()
+            return
+
+        with self.cond:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_slots:
+                self.limit += 1
+                self.successes = 0
+                self.cond.notify()
+
+
+    def record_failure(self):
+        ''' Records a request that failed, opening the circuit if the host
+            failed too many times in a row or while being probed
+        '''
+        with self.cond:
+            self.failures += 1
+            self.successes = 0
+            if self.probing or self.failures >= BREAKER_FAILURES:
+                self.opened_at = time.time()
+                self.probing = False
+
+
+    def throttle(self):
+        ''' Halves the limit after the host asked to slow down '''
+        with self.cond:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
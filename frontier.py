@@ -0,0 +1,134 @@
+from collections import deque
+
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin
+
+from beerkeg import MAX_ABV
+from utils import compile_xpath, parse_price, split_name, unique
+
+
+''' For info on XPaths, see:
+    http://www.w3schools.com/xpath/xpath_syntax.asp
+'''
+BEER_ANCHORS_XPATH = '//a[@class="ProductListItemLink"]'
+ITEM_LINKS_XPATH = './/a[@class="ProductListItemLink"]/@href'
+PAGE_LINKS_XPATH = '//div[@class="ProductListPaging"]/a/@href'
+
+
+def get_beer_id(url):
+    ''' Returns the BevMo beer id at the end of a keg url '''
+    return url.split('/')[-1]
+
+
+class KegStub(object):
+    ''' What a listing page tells about a keg before its page is fetched
+
+        price and volume are None when the listing does not show them
+    '''
+    def __init__(self, url, name='', price=None, volume=None):
+        self.url = url
+        self.beer_id = get_beer_id(url)
+        self.name = name
+        self.price = price
+        self.volume = volume
+
+
+    def get_max_ratio(self):
+        ''' Returns an upper bound on the keg's ratio, or None if unknown
+
+            No keg is stronger than MAX_ABV, so its ratio can be no higher
+            than a keg of its volume and price at that ABV
+        '''
+        if not self.price or self.volume is None:
+            return None
+        return (MAX_ABV * .1 * self.volume) / self.price
+
+
+def get_item_text(anchor):
+    ''' Returns the text of the listing item holding a keg link
+
+        Walks up from the link to the largest element holding no other keg
+    '''
+    item = anchor
+    parent = anchor.getparent()
+    while parent is not None and \
+            len(set(compile_xpath(ITEM_LINKS_XPATH)(parent))) <= 1:
+        item = parent
+        parent = parent.getparent()
+    return item.text_content()
+
+
+def parse_listing(html, page_url):
+    ''' Returns stubs for the kegs and the absolute paging links on a listing
+        page
+
+        Both come from the same parsed page so it is only fetched once
+    '''
+    stubs = []
+    seen_links = set()
+    for anchor in compile_xpath(BEER_ANCHORS_XPATH)(html):
+        href = anchor.get('href')
+        if not href or href in seen_links:
+            continue
+        seen_links.add(href)
+
+        item_text = get_item_text(anchor)
+        name, volume = split_name(anchor.text_content())
+        if not volume:
+            volume = split_name(item_text)[1] or None
+        stubs.append(KegStub(urljoin(page_url, href), name,
+                             parse_price(item_text), volume))
+
+    page_links = [urljoin(page_url, x)
+                  for x in unique(compile_xpath(PAGE_LINKS_XPATH)(html))]
+    return stubs, page_links
+
+
+class Frontier(object):
+    ''' Listing pages waiting to be crawled and the kegs already found
+
+        Pages are crawled in the order they are found, and every page url and
+        beer id is only ever accepted once
+    '''
+    def __init__(self, seed_urls=()):
+        self.pages = deque()
+        self.seen_pages = set()
+        self.seen_beers = set()
+
+        for url in seed_urls:
+            self.add_page(url)
+
+
+    def __len__(self):
+        return len(self.pages)
+
+
+    def add_page(self, url):
+        ''' Queues a listing page, returns False if it was already seen '''
+        if url in self.seen_pages:
+            return False
+        self.seen_pages.add(url)
+        self.pages.append(url)
+        return True
+
+
+    def pop_page(self):
+        ''' Returns the next listing page to crawl '''
+        return self.pages.popleft()
+
+
+    def peek_page(self):
+        ''' Returns the listing page after the current one, or None '''
+        if self.pages:
+            return self.pages[0]
+        return None
+
+
+    def add_beer(self, beer_id):
+        ''' Records a keg, returns False if it was already seen '''
+        if beer_id in self.seen_beers:
+            return False
+        self.seen_beers.add(beer_id)
+        return True
@@ -0,0 +1,202 @@
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+
+''' Seconds a cached response stays fresh, by the first matching url pattern
+
+    Listing pages change as stock moves, ABV source pages almost never do
+'''
+TTL_RULES = ((re.compile(r'ProductList\.aspx'), 60 * 60),
+             (re.compile(r'ProductDetail\.aspx'), 12 * 60 * 60),
+             (re.compile(r'bing\.com/search'), 24 * 60 * 60))
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+''' Default bound on the compressed size of all cached responses '''
+MAX_BYTES = 256 * 1024 * 1024
+
+''' Cache hits whose access times are held back before being written '''
+ACCESS_BATCH = 100
+
+
+class CacheEntry(object):
+    ''' A cached response body and its validators '''
+    def __init__(self, url, body, etag, last_modified, fetched_at, ttl):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+
+
+    def is_fresh(self):
+        return time.time() - self.fetched_at < self.ttl
+
+
+    def get_validators(self):
+        ''' Returns headers for a conditional request revalidating it '''
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache(object):
+    ''' Response cache stored in a SQLite file
+
+        Bodies are zlib compressed, entries are evicted least recently used
+        first once their total compressed size exceeds max_bytes. Access
+        times of hits are written in batches, and a cache that can't be
+        read or written, such as one locked by another process for too
+        long, acts as a miss
+    '''
+    def __init__(self, path, max_bytes=MAX_BYTES, ttl_rules=TTL_RULES,
+                 default_ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_rules = ttl_rules
+        self.default_ttl = default_ttl
+
+        ''' One connection is shared by every fetching thread '''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                          'url TEXT PRIMARY KEY, body BLOB, etag TEXT, '
+                          'last_modified TEXT, fetched_at REAL, '
+                          'accessed_at REAL, size INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                          'ON responses (accessed_at)')
+        self.conn.commit()
+
+        ''' Access times of hits not yet written, by url '''
+        self.accessed = {}
+
+
+    def get_ttl(self, url):
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+
+    def get(self, url):
+        ''' Returns the CacheEntry for url, or None if it is not cached '''
+        with self.lock:
+            try:
+                row = self.conn.execute('SELECT body, etag, last_modified, '
+                                        'fetched_at FROM responses WHERE '
+                                        'url = ?', (url,)).fetchone()
+                if row is None:
+                    return None
+
+                self.accessed[url] = time.time()
+                if len(self.accessed) >= ACCESS_BATCH:
+                    self.flush_accessed()
+                    self.conn.commit()
+            except sqlite3.Error as err:
+                self.fail(err)
+                return None
+
+        body, etag, last_modified, fetched_at = row
+        return CacheEntry(url, zlib.decompress(body), etag, last_modified,
+                          fetched_at, self.get_ttl(url))
+
+
+    def put(self, url, body, etag=None, last_modified=None):
+        ''' Stores a response body, then evicts entries beyond max_bytes '''
+        compressed = sqlite3.Binary(zlib.compress(body))
+        now = time.time()
+
+        with self.lock:
+            try:
+                self.conn.execute('INSERT OR REPLACE INTO responses VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?)',
+                                  (url, compressed, etag, last_modified, now,
+                                   now, len(compressed)))
+                self.accessed.pop(url, None)
+                self.evict()
+                self.conn.commit()
+            except sqlite3.Error as err:
+                self.fail(err)
+
+
+    def touch(self, url):
+        ''' Marks an entry fresh again after a 304 Not Modified '''
+        now = time.time()
+        with self.lock:
+            try:
+                self.conn.execute('UPDATE responses SET fetched_at = ?, '
+                                  'accessed_at = ? WHERE url = ?',
+                                  (now, now, url))
+                self.accessed.pop(url, None)
+                self.conn.commit()
+            except sqlite3.Error as err:
+                self.fail(err)
+
+
+    def flush_accessed(self):
+        ''' Writes the access times held back, without committing
+
+            Must be called while holding self.lock
+        '''
+        if self.accessed:
+            self.conn.executemany('UPDATE responses SET accessed_at = ? '
+                                  'WHERE url = ?',
+                                  [(x, url) for url, x in
+                                   self.accessed.items()])
+            self.accessed.clear()
+
+
+    def fail(self, err):
+        ''' Drops the transaction a cache error interrupted
+
+            Must be called while holding self.lock
+        '''
+        sys.stderr.write('Response cache error: {0}\n'.format(err))
+        try:
+            self.conn.rollback()
+        except sqlite3.Error:
+            pass
+
+
+    def evict(self):
+        ''' Deletes least recently used entries until under max_bytes
+
+            Must be called while holding self.lock
+        '''
+        ''' Recently used entries must look recent before choosing any '''
+        self.flush_accessed()
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) '
+                                  'FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self.conn.execute('SELECT url, size FROM responses '
+                                 'ORDER BY accessed_at')
+        stale_urls = []
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale_urls.append((url,))
+            total -= size
+        self.conn.executemany('DELETE FROM responses WHERE url = ?',
+                              stale_urls)
+
+
+    def close(self):
+        with self.lock:
+            try:
+                self.flush_accessed()
+                self.conn.commit()
+            except sqlite3.Error as err:
+                self.fail(err)
+            self.conn.close()
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+
+
+class Metrics(object):
+    ''' Counters and value statistics recorded over a crawl
+
+        Counters are summed, observed values such as timings keep their
+        count, total, min and max, and per domain counters are kept by host.
+        Hooks are called with the kind, name, value and domain of everything
+        recorded, kind being 'count' or 'observe'
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.stats = {}
+        self.domains = {}
+        self.hooks = []
+
+
+    def count(self, name, value=1, domain=None):
+        with self.lock:
+            if domain is None:
+                counters = self.counters
+            else:
+                counters = self.domains.setdefault(domain, {})
+            counters[name] = counters.get(name, 0) + value
+
+        for hook in self.hooks:
+            hook('count', name, value, domain)
+
+
+    def observe(self, name, value):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                self.stats[name] = [1, value, value, value]
+            else:
+                stat[0] += 1
+                stat[1] += value
+                stat[2] = min(stat[2], value)
+                stat[3] = max(stat[3], value)
+
+        for hook in self.hooks:
+            hook('observe', name, value, None)
+
+
+    def to_dict(self):
+        with self.lock:
+            stats = dict((name, {'count': count, 'total': total,
+                                 'mean': total / float(count), 'min': low,
+                                 'max': high})
+                         for name, (count, total, low, high)
+                         in self.stats.items())
+            return {'elapsed': time.time() - self.started_at,
+                    'counters': dict(self.counters),
+                    'stats': stats,
+                    'domains': dict((host, dict(counters)) for host, counters
+                                    in self.domains.items())}
+
+
+    def save(self, path):
+        with open(path, 'w') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2, sort_keys=True)
+
+
+''' Metrics of this process, None while recording is disabled so that every
+    recording function returns at once
+'''
+_metrics = None
+
+
+def enable():
+    ''' Starts recording, returns the Metrics recorded to '''
+    global _metrics
+
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def disable():
+    global _metrics
+    _metrics = None
+
+
+def get_metrics():
+    ''' Returns the Metrics being recorded to, or None if disabled '''
+    return _metrics
+
+
+def add_hook(hook):
+    ''' Starts recording and calls hook(kind, name, value, domain) with
+        everything recorded from then on
+    '''
+    enable().hooks.append(hook)
+
+
+def count(name, value=1):
+    metrics = _metrics
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def count_domain(host, name, value=1):
+    ''' Adds value to a counter of one domain, such as its failures '''
+    metrics = _metrics
+    if metrics is not None:
+        metrics.count(name, value, host)
+
+
+def observe(name, value):
+    ''' Records a value such as a size or number of attempts '''
+    metrics = _metrics
+    if metrics is not None:
+        metrics.observe(name, value)
+
+
+class Timer(object):
+    ''' Context manager observing the seconds spent in a block '''
+    def __init__(self, name):
+        self.name = name
+        self.started_at = None
+
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.time() - self.started_at)
+        return False
+
+
+class NullTimer(object):
+    ''' Timer used while recording is disabled '''
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = NullTimer()
+
+
+def timed(name):
+    ''' Returns a context manager timing a block as name, one that does
+        nothing while recording is disabled
+    '''
+    if _metrics is None:
+        return _NULL_TIMER
+    return Timer(name)
+
+
+def save(path):
+    ''' Writes what was recorded to path as JSON, if recording is enabled '''
+    metrics = _metrics
+    if metrics is not None:
+        metrics.save(path)
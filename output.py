@@ -0,0 +1,57 @@
+import csv
+import json
+
+from beerkeg import BeerKeg
+
+
+''' Columns of a keg record, its score first '''
+COLUMNS = ('score',) + BeerKeg.FIELDS
+
+
+def get_record(score, keg):
+    ''' Returns the fields of a keg with its score '''
+    record = keg.to_dict()
+    record['score'] = score
+    return record
+
+
+def encode(value):
+    ''' Returns value as the csv module of Python 2 can write it '''
+    if value is None:
+        return ''
+    if not isinstance(value, str) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+
+def write_jsonl(scored_kegs, out):
+    ''' Writes a JSON object per (score, keg) tuple, one per line '''
+    num_written = 0
+    for score, keg in scored_kegs:
+        out.write(json.dumps(get_record(score, keg), sort_keys=True))
+        out.write('\n')
+        out.flush()
+        num_written += 1
+    return num_written
+
+
+def write_csv(scored_kegs, out):
+    ''' Writes a header row then a row per (score, keg) tuple '''
+    writer = csv.writer(out)
+    writer.writerow(COLUMNS)
+
+    num_written = 0
+    for score, keg in scored_kegs:
+        record = get_record(score, keg)
+        writer.writerow([encode(record[x]) for x in COLUMNS])
+        out.flush()
+        num_written += 1
+    return num_written
+
+
+''' Writers by output format, each consumes an iterable of (score, keg)
+    tuples as it yields them, flushing every record, and returns the number
+    of records written
+'''
+WRITERS = {'csv': write_csv,
+           'jsonl': write_jsonl}
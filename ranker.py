@@ -0,0 +1,87 @@
+import heapq
+
+
+def alcohol_per_dollar(keg):
+    ''' Gallons of alcohol per USD, finding the keg's ABV if needed '''
+    return keg.get_ratio()
+
+
+def gallons_per_dollar(keg):
+    ''' Gallons of beer per USD, ranking the lowest price per gallon first '''
+    keg.parse()
+    if not keg.price or not keg.volume:
+        return None
+    return keg.volume / keg.price
+
+
+''' Score functions by name, a higher score ranks a keg higher and None
+    leaves it unranked
+'''
+SCORES = {'alcohol': alcohol_per_dollar,
+          'volume': gallons_per_dollar}
+
+
+class TopK(object):
+    ''' Keeps the k highest scoring items seen so far
+
+        Pushing is O(log k). Items without a score are counted but never
+        ranked, and ties keep the item pushed first ahead
+    '''
+    def __init__(self, k, on_update=None):
+        self.k = k
+
+        ''' Called with a snapshot whenever the top items change '''
+        self.on_update = on_update
+
+        ''' Min heap of (score, -order, item), the lowest ranked item first
+            order is unique so items themselves are never compared
+        '''
+        self.heap = []
+        self.num_pushed = 0
+        self.num_missing = 0
+
+
+    def __len__(self):
+        return len(self.heap)
+
+
+    def push(self, score, item):
+        ''' Offers an item, returns True if it entered the top k '''
+        if score is None:
+            self.num_missing += 1
+            return False
+
+        entry = (score, -self.num_pushed, item)
+        self.num_pushed += 1
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+        else:
+            return False
+
+        if self.on_update is not None:
+            self.on_update(self.snapshot())
+        return True
+
+
+    def threshold(self):
+        ''' Returns the score an item must beat to enter, None if not full '''
+        if len(self.heap) < self.k:
+            return None
+        return self.heap[0][0]
+
+
+    def snapshot(self):
+        ''' Returns (score, item) tuples of the top items, best first '''
+        return [(score, item) for score, _, item in
+                sorted(self.heap, key=lambda x: x[:2], reverse=True)]
+
+
+def rank(items, k, score=alcohol_per_dollar):
+    ''' Returns (score, item) tuples of the k best items, best first '''
+    top = TopK(k)
+    for item in items:
+        top.push(score(item), item)
+    return top.snapshot()
@@ -0,0 +1,223 @@
+import io
+import json
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    from urlparse import urlparse, urlunparse
+except ImportError:
+    from urllib.parse import urlparse, urlunparse
+
+
+''' Header telling a stand-in server which host a request was meant for '''
+ORIGINAL_HOST_HEADER = 'X-Original-Host'
+
+''' Headers describing the body as it was sent, not as it is recorded '''
+_TRANSFER_HEADERS = ('content-encoding', 'content-length',
+                     'transfer-encoding')
+
+
+class FixtureArchive(object):
+    ''' Responses recorded in a SQLite file, keyed by url
+
+        Bodies are stored decoded and zlib compressed, with the status code
+        and headers they were served with
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        ''' One connection is shared by every fetching thread '''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fixtures ('
+                          'url TEXT PRIMARY KEY, status_code INTEGER, '
+                          'headers TEXT, body BLOB)')
+        self.conn.commit()
+
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM '
+                                     'fixtures').fetchone()[0]
+
+
+    def get(self, url):
+        ''' Returns a tuple of the status code, headers and body recorded for
+            url, or None if it was never recorded
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT status_code, headers, body FROM '
+                                    'fixtures WHERE url = ?',
+                                    (url,)).fetchone()
+        if row is None:
+            return None
+
+        status_code, headers, body = row
+        return status_code, json.loads(headers), zlib.decompress(body)
+
+
+    def put(self, url, status_code, headers, body):
+        headers = dict((key, value) for key, value in headers.items()
+                       if key.lower() not in _TRANSFER_HEADERS)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO fixtures VALUES '
+                              '(?, ?, ?, ?)',
+                              (url, status_code, json.dumps(headers),
+                               sqlite3.Binary(zlib.compress(body))))
+            self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def make_response(request, status_code, headers, body):
+    ''' Returns a requests Response serving body to request '''
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = CaseInsensitiveDict(headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.raw = io.BytesIO(body)
+    response.url = request.url
+    response.request = request
+    return response
+
+
+class ReplayAdapter(BaseAdapter):
+    ''' Transport serving every request from a FixtureArchive, without any
+        network access
+
+        Requests for urls that were never recorded fail with a connection
+        error
+    '''
+    def __init__(self, archive):
+        super(ReplayAdapter, self).__init__()
+        self.archive = archive
+
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        fixture = self.archive.get(request.url)
+        if fixture is None:
+            raise requests.ConnectionError('{0} is not in the fixture '
+                                           'archive'.format(request.url),
+                                           request=request)
+        return make_response(request, *fixture)
+
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(BaseAdapter):
+    ''' Transport recording every response of another into a FixtureArchive
+
+        Responses are read whole so they can be recorded
+    '''
+    def __init__(self, archive, adapter):
+        super(RecordingAdapter, self).__init__()
+        self.archive = archive
+        self.adapter = adapter
+
+
+    def send(self, request, **kwargs):
+        url = request.url
+        response = self.adapter.send(request, **kwargs)
+
+        ''' A 304 only confirms a response recorded earlier '''
+        if response.status_code != 304:
+            self.archive.put(url, response.status_code, response.headers,
+                             response.content)
+        return response
+
+
+    def close(self):
+        self.adapter.close()
+
+
+class RedirectAdapter(HTTPAdapter):
+    ''' Transport sending every request to a stand-in server at base_url
+
+        The path and query are kept and the host the request was meant for
+        is sent in the ORIGINAL_HOST_HEADER header
+    '''
+    def __init__(self, base_url, **kwargs):
+        super(RedirectAdapter, self).__init__(**kwargs)
+        self.base_url = urlparse(base_url)
+
+
+    def send(self, request, **kwargs):
+        url = urlparse(request.url)
+        request.headers[ORIGINAL_HOST_HEADER] = url.netloc
+        request.url = urlunparse((self.base_url.scheme, self.base_url.netloc) +
+                                 url[2:])
+        return super(RedirectAdapter, self).send(request, **kwargs)
+
+
+class FaultyAdapter(BaseAdapter):
+    ''' Transport delaying the requests of another by a random time around
+        latency seconds and failing an error_rate share of them, half with a
+        connection error and half with a 503 status
+    '''
+    def __init__(self, adapter, latency=0.0, error_rate=0.0, seed=None):
+        super(FaultyAdapter, self).__init__()
+        self.adapter = adapter
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.random.uniform(.5, 1.5) * self.latency)
+
+        if self.random.random() < self.error_rate:
+            if self.random.random() < .5:
+                raise requests.ConnectionError('Simulated connection error',
+                                               request=request)
+            return make_response(request, 503, {'Content-Length': '0'}, b'')
+
+        return self.adapter.send(request, **kwargs)
+
+
+    def close(self):
+        self.adapter.close()
+
+
+def get_transport(record=None, replay=None, standin=None, latency=0.0,
+                  error_rate=0.0, pool_size=10):
+    ''' Returns the transport adapter for requests to go through, or None to
+        fetch over the network as usual
+
+        record and replay are paths of fixture archives, standin is the base
+        url of a stand-in server to fetch from in place of the network, and
+        may be recorded. latency and error_rate are simulated on top of
+        whichever is used
+    '''
+    if not (record or replay or standin or latency or error_rate):
+        return None
+
+    if replay:
+        adapter = ReplayAdapter(FixtureArchive(replay))
+    elif standin:
+        adapter = RedirectAdapter(standin, pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+    else:
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+
+    if record and not replay:
+        adapter = RecordingAdapter(FixtureArchive(record), adapter)
+    if latency or error_rate:
+        adapter = FaultyAdapter(adapter, latency, error_rate)
+    return adapter
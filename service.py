@@ -0,0 +1,238 @@
+''' Query service answering keg rankings over HTTP from a warm catalog
+
+    The catalog is refreshed on a background thread and each refresh is
+    swapped in whole, so queries never wait on a crawl and never see a
+    catalog half updated
+'''
+
+import json
+import threading
+import traceback
+
+from columns import KegColumns
+from ranker import SCORES
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+
+''' Seconds between the end of a refresh and the start of the next '''
+REFRESH_SECONDS = 60 * 60
+
+''' Most kegs a single query may ask for '''
+MAX_TOP = 1000
+
+
+class QueryError(ValueError):
+    ''' Raised for a query with invalid parameters '''
+    pass
+
+
+class Snapshot(object):
+    ''' A catalog with its columns, never changed once built '''
+    __slots__ = ('catalog', 'columns', 'updated_at')
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.columns = KegColumns.from_catalog(catalog)
+        self.updated_at = catalog.updated_at
+
+
+def get_words(params, name):
+    ''' Returns the words of a query parameter given once or repeated,
+        separated by spaces or commas
+    '''
+    return ' '.join(params.get(name, [])).replace(',', ' ').split()
+
+
+def get_number(params, name, kind=float, default=None):
+    ''' Returns a numeric query parameter, or default if it is missing '''
+    values = params.get(name)
+    if not values or not values[-1]:
+        return default
+    try:
+        return kind(values[-1])
+    except ValueError:
+        raise QueryError('{0} must be a number'.format(name))
+
+
+class QueryService(object):
+    ''' Ranks the kegs of the current snapshot for queries from any thread
+
+        refresh is called with no arguments on the refresh thread and returns
+        the updated Catalog, which must not be changed afterwards
+    '''
+    def __init__(self, refresh, catalog=None):
+        self.refresh = refresh
+
+        ''' Replaced by a new Snapshot on every refresh, readers take the
+            reference once and rank from it without locking
+        '''
+        self.snapshot = Snapshot(catalog) if catalog else None
+
+        self.refreshing = False
+        self.num_refreshes = 0
+        self.last_error = None
+        self.stopped = threading.Event()
+
+
+    def swap(self, catalog):
+        ''' Makes catalog the one queries are ranked from '''
+        self.snapshot = Snapshot(catalog)
+
+
+    def refresh_now(self):
+        ''' Refreshes the catalog, keeping the old one if the refresh fails '''
+        self.refreshing = True
+        try:
+            self.swap(self.refresh())
+            self.num_refreshes += 1
+            self.last_error = None
+        except Exception as err:
+            self.last_error = str(err) or err.__class__.__name__
+            traceback.print_exc()
+        finally:
+            self.refreshing = False
+
+
+    def run_refreshes(self, seconds=REFRESH_SECONDS):
+        ''' Refreshes the catalog every seconds until stopped '''
+        while not self.stopped.is_set():
+            self.refresh_now()
+            self.stopped.wait(seconds)
+
+
+    def start(self, seconds=REFRESH_SECONDS):
+        ''' Runs the refreshes on a background thread '''
+        thread = threading.Thread(target=self.run_refreshes, args=(seconds,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+    def stop(self):
+        self.stopped.set()
+
+
+    def query(self, params):
+        ''' Returns the top kegs for query parameters parsed by parse_qs
+
+            Takes top, price, min_volume, min_available, filter, unfilter
+            and score, named and defaulted as the command line options
+        '''
+        top = get_number(params, 'top', int, 3)
+        if not 0 < top <= MAX_TOP:
+            raise QueryError('top must be from 1 to {0}'.format(MAX_TOP))
+
+        score = get_words(params, 'score') or ['alcohol']
+        if score[0] not in SCORES:
+            raise QueryError('score must be one of {0}'.format(
+                ', '.join(sorted(SCORES))))
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {'updated_at': None, 'num_kegs': 0, 'kegs': []}
+
+        ''' Keyword filters are answered by the catalog's word index '''
+        all_of = get_words(params, 'filter')
+        none_of = get_words(params, 'unfilter')
+        beer_ids = None
+        if all_of or none_of:
+            beer_ids = snapshot.catalog.search(all_of, none_of)
+
+        columns = snapshot.columns
+        rows = columns.select(get_number(params, 'price'),
+                              get_number(params, 'min_volume'),
+                              get_number(params, 'min_available', int),
+                              beer_ids)
+
+        kegs = []
+        for value, row in columns.top(top, score[0], rows):
+            keg = dict(columns.records[row])
+            keg['score'] = value
+            kegs.append(keg)
+
+        return {'updated_at': snapshot.updated_at,
+                'num_kegs': len(columns), 'kegs': kegs}
+
+
+    def get_status(self):
+        snapshot = self.snapshot
+        return {'updated_at': snapshot and snapshot.updated_at,
+                'num_kegs': len(snapshot.columns) if snapshot else 0,
+                'refreshing': self.refreshing,
+                'num_refreshes': self.num_refreshes,
+                'last_error': self.last_error}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    ''' Answers GET /kegs with the top kegs for the query string and
+        GET /status with the state of the catalog and its refreshes
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+
+        if url.path == '/kegs':
+            try:
+                self.send_json(service.query(parse_qs(url.query)))
+            except QueryError as err:
+                self.send_json({'error': str(err)}, 400)
+        elif url.path == '/status':
+            self.send_json(service.get_status())
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+
+    def send_json(self, data, status_code=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        pass
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    ''' HTTP server answering each query on its own thread '''
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, QueryHandler)
+        self.service = service
+
+
+    def get_url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+
+def serve(service, port, refresh_seconds=REFRESH_SECONDS):
+    ''' Answers queries on a local port while the catalog is refreshed in
+        the background, until interrupted
+    '''
+    server = QueryServer(('127.0.0.1', port), service)
+    service.start(refresh_seconds)
+    print('Answering queries at {0}/kegs'.format(server.get_url()))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
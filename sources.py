@@ -0,0 +1,160 @@
+import random
+import sqlite3
+import sys
+import threading
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+''' Pages and hits every domain is assumed to start with, so a domain is
+    neither trusted nor dismissed on its first few pages
+'''
+PRIOR_PAGES = 3.0
+PRIOR_HITS = 1.0
+
+''' Domains scanned at least MIN_PAGES times whose hit rate stays below
+    MIN_HIT_RATE are skipped, except for an EXPLORE_RATE share of searches
+    that try them again in case they improved
+'''
+MIN_PAGES = 10
+MIN_HIT_RATE = 0.05
+EXPLORE_RATE = 0.1
+
+''' Scans recorded before they are written to disk in one commit '''
+RECORD_BATCH = 50
+
+
+def get_domain(url):
+    ''' Returns the host of url without a leading www. '''
+    domain = urlparse(url).netloc.lower()
+    if domain.startswith('www.'):
+        domain = domain[4:]
+    return domain
+
+
+class SourceStats(object):
+    ''' How well each domain answered ABV searches, stored in a SQLite file
+
+        A domain's record counts the pages scanned, the pages an ABV was
+        found on and pages that failed, with the total seconds and bytes
+        spent on them. Candidate pages are ranked by the domain's hit rate
+
+        Scans are written as increments in batches, so processes sharing the
+        file add to each other's counts. flush writes the rest
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        ''' One connection is shared by every keg worker '''
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60,
+                                    check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sources ('
+                          'domain TEXT PRIMARY KEY, pages INTEGER, '
+                          'hits INTEGER, failures INTEGER, seconds REAL, '
+                          'hit_bytes INTEGER)')
+        self.conn.commit()
+
+        self.stats = {}
+        for row in self.conn.execute('SELECT * FROM sources'):
+            self.stats[row[0]] = list(row[1:])
+
+        ''' Increments of each domain not yet written, and their scans '''
+        self.pending = {}
+        self.num_pending = 0
+
+
+    def record(self, url, found, seconds, num_bytes=0, failed=False):
+        ''' Records a scan of the page at url and whether it had an ABV '''
+        domain = get_domain(url)
+        scan = (1, int(bool(found)), int(bool(failed)), seconds,
+                num_bytes if found else 0)
+        with self.lock:
+            for stats in (self.stats.setdefault(domain, [0, 0, 0, 0.0, 0]),
+                          self.pending.setdefault(domain, [0, 0, 0, 0.0, 0])):
+                for i, value in enumerate(scan):
+                    stats[i] += value
+
+            self.num_pending += 1
+            if self.num_pending >= RECORD_BATCH:
+                self.write_pending()
+
+
+    def write_pending(self):
+        ''' Adds the pending increments to the stored counts in one commit,
+            keeping them for the next try if that fails
+
+            Must be called while holding self.lock
+        '''
+        if not self.pending:
+            return
+
+        try:
+            self.conn.executemany('INSERT OR IGNORE INTO sources VALUES '
+                                  '(?, 0, 0, 0, 0.0, 0)',
+                                  [(x,) for x in self.pending])
+            self.conn.executemany('UPDATE sources SET pages = pages + ?, '
+                                  'hits = hits + ?, '
+                                  'failures = failures + ?, '
+                                  'seconds = seconds + ?, '
+                                  'hit_bytes = hit_bytes + ? '
+                                  'WHERE domain = ?',
+                                  [tuple(stats) + (domain,) for domain, stats
+                                   in self.pending.items()])
+            self.conn.commit()
+        except sqlite3.Error as err:
+            sys.stderr.write('Source stats error: {0}\n'.format(err))
+            self.conn.rollback()
+            return
+
+        self.pending.clear()
+        self.num_pending = 0
+
+
+    def flush(self):
+        ''' Writes the scans recorded since the last batch '''
+        with self.lock:
+            self.write_pending()
+
+
+    def get_hit_rate(self, url):
+        ''' Returns the smoothed share of the domain's pages with an ABV '''
+        pages, hits = self.stats.get(get_domain(url), (0, 0))[:2]
+        return (hits + PRIOR_HITS) / (pages + PRIOR_PAGES)
+
+
+    def get_rank_key(self, url):
+        ''' Returns the hit rate to two places then the negated mean seconds
+            per page, so of domains hitting as often the faster comes first
+        '''
+        stats = self.stats.get(get_domain(url))
+        seconds = stats[3] / stats[0] if stats else 0.0
+        return round(self.get_hit_rate(url), 2), -seconds
+
+
+    def is_useless(self, url):
+        ''' Returns True if the domain rarely had an ABV over enough pages '''
+        pages, hits = self.stats.get(get_domain(url), (0, 0))[:2]
+        return pages >= MIN_PAGES and hits < MIN_HIT_RATE * pages
+
+
+    def rank(self, urls):
+        ''' Returns urls ordered by their domain's hit rate and speed, leaving
+            out useless domains
+
+            Ties keep their order, so domains never scanned stay in search
+            result order
+        '''
+        explore = random.random() < EXPLORE_RATE
+        kept = [x for x in urls if explore or not self.is_useless(x)]
+        return sorted(kept, key=self.get_rank_key, reverse=True)
+
+
+    def close(self):
+        with self.lock:
+            self.write_pending()
+            self.conn.close()
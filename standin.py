@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+''' Local stand-in for BevMo, Bing and the sites ABVs are found on
+
+    Serves a synthetic keg catalog of any size, search results and ABV
+    pages, generated from each keg's number so no catalog is held in
+    memory. Run it and crawl it with choosemybeer.py --standin URL
+'''
+
+import argparse
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+from replay import ORIGINAL_HOST_HEADER
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from urllib.parse import parse_qs, urlparse
+
+
+''' Kegs listed per listing page and listing pages linked from each '''
+PAGE_SIZE = 20
+PAGE_LINKS = 10
+
+''' Number of ABV sites search results link to, site k has an ABV on a
+    beer's page with a chance of ABV_SITE_HIT_RATES[k % 4]
+'''
+NUM_ABV_SITES = 8
+ABV_SITE_HIT_RATES = (.05, .3, .6, .9)
+
+''' Bytes of filler around the content of detail and ABV pages, about the
+    size of the real pages
+'''
+DETAIL_FILLER = 30 * 1024
+ABV_FILLER = 60 * 1024
+
+BREWERIES = ('Anchor', 'Bear Republic', 'Deschutes', 'Firestone Walker',
+             'Lagunitas', 'New Belgium', 'Sierra Nevada', 'Stone')
+STYLES = ('Amber Ale', 'Brown Ale', 'Hefeweizen', 'IPA', 'Lager',
+          'Pale Ale', 'Pilsner', 'Porter', 'Stout')
+FLAVORS = ('bitter', 'citrus', 'crisp', 'dark', 'fruity', 'hoppy', 'malty',
+           'roasty', 'smooth')
+VOLUMES = ('5.16', '7.75', '13.2', '15.5')
+
+
+def get_filler(num_bytes):
+    return '<div class="Filler">{0}</div>'.format('lorem ipsum ' *
+                                                 (num_bytes // 12))
+
+
+class SyntheticCatalog(object):
+    ''' Synthetic kegs numbered from 0, two sizes of each beer, and the pages
+        showing them
+    '''
+    def __init__(self, num_kegs, seed=0):
+        self.num_kegs = num_kegs
+        self.seed = seed
+
+
+    def get_beer(self, beer):
+        ''' Returns the name, ABV and description of a beer number '''
+        rand = random.Random(self.seed * 1000003 + beer)
+        name = '{0} {1} {2}'.format(rand.choice(BREWERIES),
+                                    rand.choice(STYLES), beer)
+        abv = round(rand.uniform(3.5, 12.0), 1)
+        desc = 'A {0} and {1} beer.'.format(*rand.sample(FLAVORS, 2))
+        return name, abv, desc
+
+
+    def get_keg(self, keg):
+        ''' Returns the name, volume, price, number available and
+            description of a keg number
+        '''
+        name, _, desc = self.get_beer(keg // 2)
+        rand = random.Random(self.seed * 1000003 + keg + 500000)
+        volume = VOLUMES[keg % 2 * 2 + rand.randint(0, 1)]
+        price = round(float(volume) * rand.uniform(8.0, 16.0), 2)
+        return name, volume, price, rand.randint(0, 9), desc
+
+
+    def render_listing(self, offset):
+        ''' Returns a listing page of kegs from offset with links to the
+            listing pages after it
+        '''
+        items = []
+        for keg in range(offset, min(offset + PAGE_SIZE, self.num_kegs)):
+            name, volume, price, _, _ = self.get_keg(keg)
+            items.append('<div class="ProductListItem"><a class="Product'
+                         'ListItemLink" href="/Shop/ProductDetail.aspx/Beer/'
+                         'Kegs/{0}">{1} ({2} Gal.)</a><span class="Product'
+                         'ListItemPrice">${3:.2f}</span></div>'.format(
+                             keg, name, volume, price))
+
+        ''' Link the next PAGE_LINKS pages, as the paging bar would '''
+        links = []
+        for page in range(1, PAGE_LINKS + 1):
+            page_offset = offset + page * PAGE_SIZE
+            if page_offset >= self.num_kegs:
+                break
+            links.append('<a href="/Shop/ProductList.aspx/Beer/Kegs/_/'
+                         'N-15Z1z141vn/No-{0}?DNID=Beer">{1}</a>'.format(
+                             page_offset, page_offset // PAGE_SIZE + 1))
+
+        return ('<html><body>{0}<div class="ProductListPaging">{1}</div>'
+                '</body></html>'.format(''.join(items), ''.join(links)))
+
+
+    def render_keg(self, keg):
+        ''' Returns the detail page of a keg '''
+        name, volume, price, num_avail, desc = self.get_keg(keg)
+        return ('<html><body><h1>{0} ({1} Gal.)</h1><span class="Product'
+                'DetailItemPrice">${2:.2f}</span><em>{3} Available</em>'
+                '<table><tr><td class="ProductDetailCell"><p>{4}</p></td>'
+                '</tr></table>{5}</body></html>'.format(
+                    name, volume, price, num_avail, desc,
+                    get_filler(DETAIL_FILLER)))
+
+
+    def render_abv(self, site, beer):
+        ''' Returns the page of ABV site number site about a beer, showing
+            its ABV if the site has it
+        '''
+        rand = random.Random(self.seed * 1000003 + beer * 31 + site)
+        text = '<p>No information about this beer.</p>'
+        if rand.random() < ABV_SITE_HIT_RATES[site % 4]:
+            text = '<p>ABV: {0}%</p>'.format(self.get_beer(beer)[1])
+
+        filler = get_filler(ABV_FILLER // 2)
+        return '<html><body>{0}{1}{0}</body></html>'.format(filler, text)
+
+
+def render_search(query):
+    ''' Returns search results linking a page about the searched beer on
+        every ABV site
+    '''
+    query = re.sub(r'\s*alcohol content\s*$', '', query.strip())
+    slug = '-'.join(query.split())
+
+    links = ''.join('<li><a href="http://www.abvsite{0}.com/beer/{1}">{2}'
+                    '</a></li>'.format(k, slug, query)
+                    for k in range(NUM_ABV_SITES))
+    return ('<html><body><a href="#">Images</a><a href="javascript:">Tools'
+            '</a><ol>{0}</ol></body></html>'.format(links))
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    ''' Answers requests for BevMo listing and keg pages, Bing searches and
+        ABV pages, telling them apart by path and original host
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.random.uniform(.5, 1.5) * server.latency)
+        if server.random.random() < server.error_rate:
+            self.send_page('', 503)
+            return
+
+        catalog = server.catalog
+        url = urlparse(self.path)
+        host = self.headers.get(ORIGINAL_HOST_HEADER) or \
+            self.headers.get('Host', '')
+
+        if 'ProductList.aspx' in url.path:
+            offset = re.search(r'No-(\d+)', url.path)
+            self.send_page(catalog.render_listing(int(offset.group(1))
+                                                  if offset else 0))
+        elif 'ProductDetail.aspx' in url.path:
+            keg = re.search(r'/(\d+)/?$', url.path)
+            if keg and int(keg.group(1)) < catalog.num_kegs:
+                self.send_page(catalog.render_keg(int(keg.group(1))))
+            else:
+                self.send_page('Not found', 404)
+        elif url.path == '/search':
+            self.send_page(render_search(parse_qs(url.query).get('q',
+                                                                 [''])[0]))
+        elif url.path.startswith('/beer/'):
+            site = re.search(r'abvsite(\d+)', host)
+            beer = re.search(r'(\d+)$', url.path)
+            if site and beer:
+                self.send_page(catalog.render_abv(int(site.group(1)),
+                                                  int(beer.group(1))))
+            else:
+                self.send_page('Not found', 404)
+        else:
+            self.send_page('Not found', 404)
+
+
+    def send_page(self, body, status_code=200):
+        body = body.encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, *args):
+        pass
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    ''' Stand-in HTTP server answering each request on its own thread '''
+    daemon_threads = True
+
+    def __init__(self, address, catalog, latency=0.0, error_rate=0.0):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(catalog.seed)
+
+
+    def handle_error(self, request, client_address):
+        ''' Crawlers hang up on pages once they found what they looked for '''
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+    def get_url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+
+def start(num_kegs, port=0, latency=0.0, error_rate=0.0, seed=0):
+    ''' Serves a catalog of num_kegs kegs on a background thread
+
+        Returns the StandinServer, port 0 picks a free port. Call shutdown()
+        on it to stop serving
+    '''
+    server = StandinServer(('127.0.0.1', port),
+                           SyntheticCatalog(num_kegs, seed), latency,
+                           error_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='serve a synthetic keg '
+                                                 'catalog to crawl offline')
+    parser.add_argument('-k', '--kegs', type=int, default=1000,
+                        help='number of kegs to list (default: 1000)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to serve on (default: 8000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of latency per response (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of responses to fail with a 503 '
+                             '(default: 0)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generated catalog (default: 0)')
+    return parser
+
+
+def command_line_runner():
+    args = vars(get_parser().parse_args())
+    server = StandinServer(('127.0.0.1', args['port']),
+                           SyntheticCatalog(args['kegs'], args['seed']),
+                           args['latency'], args['error_rate'])
+    print('Serving {} kegs at {}'.format(args['kegs'], server.get_url()))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == '__main__':
+    command_line_runner()
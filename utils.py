@@ -1,9 +1,16 @@
+import os
 import random
+import re
 import string
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
-import lxml.html as lh
-import requests
+import metrics
+from fetchpolicy import (MAX_RETRIES, RETRY_STATUSES, THROTTLE_STATUSES,
+                         HostLimit, get_backoff, is_failure)
 
 
 try:
@@ -11,6 +18,16 @@ try:
 except ImportError:
     from urllib.request import getproxies
 
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    from htmlentitydefs import name2codepoint
+except ImportError:
+    from html.entities import name2codepoint
+
 
 USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) '
                'Gecko/20100101 Firefox/11.0',
@@ -26,7 +43,16 @@ USER_AGENTS = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10.7; rv:11.0) '
                'Chrome/19.0.1084.46 Safari/536.5')
 
 
+''' Proxies are resolved from the environment once per process '''
+_proxies = None
+
+
 def get_proxies():
+    global _proxies
+
+    if _proxies is not None:
+        return _proxies
+
     proxies = getproxies()
     filtered_proxies = {}
     for key, value in proxies.items():
@@ -35,30 +61,613 @@ def get_proxies():
                 filtered_proxies[key] = 'http://{0}'.format(value)
             else:
                 filtered_proxies[key] = value
+    _proxies = filtered_proxies
     return filtered_proxies
 
 
-def get_html(url):
+''' Limits on the number of fetches in flight, shared by every caller of
+    get_html whether it runs on the main thread, a keg worker or the fetch pool
+'''
+MAX_CONNECTIONS = 32
+MAX_HOST_CONNECTIONS = 8
+
+''' Minimum seconds between the starts of two requests to one host '''
+HOST_DELAY = 0.0
+
+''' Seconds to wait for a connection and between bytes of a response '''
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 30.0
+
+_global_slots = threading.BoundedSemaphore(MAX_CONNECTIONS)
+_host_slots = {}
+_host_next_start = {}
+_slots_lock = threading.Lock()
+_fetch_pool = None
+_session = None
+
+''' Transport adapter every request goes through, None for the network '''
+_transport = None
+
+''' Directory holding the response cache and other persistent state '''
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.choosemybeer')
+
+''' HttpCache used by get_content, or None to always fetch '''
+_http_cache = None
+
+
+def set_http_cache(cache):
+    ''' Sets the HttpCache consulted before every fetch, None disables it '''
+    global _http_cache
+    _http_cache = cache
+
+
+def get_cache_path(cache_dir, filename):
+    ''' Returns the path of filename in cache_dir, creating the directory '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, filename)
+
+
+def set_fetch_limits(max_connections=None, max_host_connections=None):
+    ''' Sets the global and per host limits on concurrent fetches
+
+        Should be called before any fetches are started
+    '''
+    global MAX_CONNECTIONS, MAX_HOST_CONNECTIONS, _global_slots, _fetch_pool
+    global _session
+
+    with _slots_lock:
+        if max_connections:
+            MAX_CONNECTIONS = max_connections
+            _global_slots = threading.BoundedSemaphore(max_connections)
+            if _fetch_pool is not None:
+                _fetch_pool.close()
+                _fetch_pool = None
+        if max_host_connections:
+            MAX_HOST_CONNECTIONS = max_host_connections
+            _host_slots.clear()
+            _session = None
+
+
+def set_timeouts(connect_timeout=None, read_timeout=None):
+    ''' Sets the connect and read timeouts in seconds for every fetch '''
+    global CONNECT_TIMEOUT, READ_TIMEOUT
+
+    if connect_timeout:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout:
+        READ_TIMEOUT = read_timeout
+
+
+def set_transport(adapter):
+    ''' Sets the requests transport adapter every fetch goes through, such as
+        one replaying recorded responses, None fetches over the network
+    '''
+    global _session, _transport
+
+    with _slots_lock:
+        _transport = adapter
+        _session = None
+
+
+def get_session():
+    ''' Returns the requests session shared by every fetch
+
+        The session keeps a pool of up to MAX_HOST_CONNECTIONS keep-alive
+        connections per host, and its User-Agent and proxies are chosen once
+    '''
+    global _session
+
+    ''' requests is only imported by processes that fetch '''
+    import requests
+
+    with _slots_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = _transport
+            if adapter is None:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=MAX_CONNECTIONS,
+                    pool_maxsize=MAX_HOST_CONNECTIONS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = random.choice(USER_AGENTS)
+            session.proxies.update(get_proxies())
+            _session = session
+        return _session
+
+
+def set_host_delay(host_delay=None):
+    ''' Sets the minimum seconds between requests to the same host '''
+    global HOST_DELAY
+
+    if host_delay is not None:
+        HOST_DELAY = host_delay
+
+
+def wait_for_host(url):
+    ''' Sleeps until a request to the url's host is allowed to start '''
+    if not HOST_DELAY:
+        return
+
+    host = urlparse(url).netloc
+    with _slots_lock:
+        now = time.time()
+        start = max(now, _host_next_start.get(host, now))
+        _host_next_start[host] = start + HOST_DELAY
+
+    if start > now:
+        time.sleep(start - now)
+
+
+def get_host_slots(url):
+    ''' Returns the HostLimit of the url's host '''
+    host = urlparse(url).netloc
+    with _slots_lock:
+        if host not in _host_slots:
+            _host_slots[host] = HostLimit(MAX_HOST_CONNECTIONS)
+        return _host_slots[host]
+
+
+def get_fetch_pool():
+    ''' Returns the thread pool used for background fetches '''
+    global _fetch_pool
+
+    with _slots_lock:
+        if _fetch_pool is None:
+            _fetch_pool = ThreadPool(MAX_CONNECTIONS)
+        return _fetch_pool
+
+
+@contextmanager
+def open_url(url, headers=None, stream=False):
+    ''' Context manager requesting url, yields the response
+
+        The host and global fetch slots are held until the block exits.
+        Requests failing with an error or a retryable status are retried
+        with jittered exponential backoff, and the last response is yielded
+        if every retry failed with a status. Raises IOError if the request
+        failed with an error or the url's host is being skipped
+    '''
+    host = urlparse(url).netloc
+    host_slots = get_host_slots(url)
+
+    for retry in xrange(MAX_RETRIES + 1):
+        if not host_slots.allow():
+            metrics.count_domain(host, 'skipped')
+            raise IOError('Skipped {0}, {1} keeps failing'.format(url, host))
+
+        ''' Host slots are always taken before global slots to avoid
+            deadlock
+        '''
+        with host_slots:
+            with _global_slots:
+                wait_for_host(url)
+                started = time.time()
+                try:
+                    with metrics.timed('fetch'):
+                        response = get_session().get(url, headers=headers,
+                                                     stream=stream,
+                                                     timeout=(CONNECT_TIMEOUT,
+                                                              READ_TIMEOUT))
+                except Exception as err:
+                    host_slots.record_failure()
+                    metrics.count_domain(host, 'failures')
+                    if retry == MAX_RETRIES:
+                        raise IOError(str(err))
+                    delay = get_backoff(retry)
+                else:
+                    metrics.count_domain(host, 'fetches')
+                    status_code = response.status_code
+                    if status_code in THROTTLE_STATUSES:
+                        host_slots.throttle()
+
+                    if status_code in RETRY_STATUSES and retry < MAX_RETRIES:
+                        host_slots.record_failure()
+                        metrics.count_domain(host, 'failures')
+                        retry_after = response.headers.get('Retry-After')
+                        delay = get_backoff(retry, retry_after)
+                        response.close()
+                    else:
+                        try:
+                            yield response
+                        except Exception:
+                            host_slots.record_failure()
+                            metrics.count_domain(host, 'failures')
+                            raise
+                        finally:
+                            response.close()
+
+                        if is_failure(status_code):
+                            host_slots.record_failure()
+                            metrics.count_domain(host, 'failures')
+                        else:
+                            host_slots.record_success(time.time() - started)
+                        return
+
+        ''' Wait out the backoff without holding any slot '''
+        metrics.count('fetch.retries')
+        time.sleep(delay)
+
+
+class FetchResult(object):
+    ''' Outcome of fetching a url
+
+        status is OK with the body in content, EMPTY if the server answered
+        without a page, with an empty body or a 404 or 410 status, or FAILED
+        if the page could not be retrieved, with the reason in error
+    '''
+    OK = 'ok'
+    EMPTY = 'empty'
+    FAILED = 'failed'
+
+    def __init__(self, url, status, content=None, status_code=None,
+                 error=None):
+        self.url = url
+        self.status = status
+        self.content = content
+        self.status_code = status_code
+        self.error = error
+
+
+def fetch(url):
+    ''' Returns the FetchResult of url, with the decoded response body as
+        bytes if it is OK
+
+        Fresh responses are served from the cache without a request, stale
+        ones are revalidated with their ETag or Last-Modified date
+    '''
+    entry = None
+    headers = {}
+    if _http_cache is not None:
+        entry = _http_cache.get(url)
+        if entry is not None:
+            if entry.is_fresh():
+                metrics.count('cache.hits')
+                return FetchResult(url, FetchResult.OK, entry.body, 200)
+            headers = entry.get_validators()
+        else:
+            metrics.count('cache.misses')
+
     try:
-        ''' Get HTML response as an lxml.html.HtmlElement object '''
-        headers = {'User-Agent': random.choice(USER_AGENTS)}
-        request = requests.get(url, headers=headers, proxies=get_proxies())
-        return lh.fromstring(request.text.encode('utf-8'))
+        with open_url(url, headers) as response:
+            ''' The body is already gzip decoded by the session '''
+            content = response.content
     except Exception as err:
         sys.stderr.write('Failed to retrieve {0}.\n'.format(url))
         sys.stderr.write('{0}\n'.format(str(err)))
+        return FetchResult(url, FetchResult.FAILED, error=str(err))
+
+    status_code = response.status_code
+    if entry is not None and status_code == 304:
+        metrics.count('cache.revalidated')
+        _http_cache.touch(url)
+        return FetchResult(url, FetchResult.OK, entry.body, 200)
+
+    metrics.count('fetch.bytes', len(content))
+    metrics.count_domain(urlparse(url).netloc, 'bytes', len(content))
+
+    if status_code in (404, 410) or (status_code == 200 and not content):
+        return FetchResult(url, FetchResult.EMPTY, status_code=status_code)
+    if status_code != 200:
+        error = 'HTTP {0}'.format(status_code)
+        sys.stderr.write('Failed to retrieve {0}.\n{1}\n'.format(url, error))
+        return FetchResult(url, FetchResult.FAILED, status_code=status_code,
+                           error=error)
+
+    if _http_cache is not None:
+        _http_cache.put(url, content, response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+    return FetchResult(url, FetchResult.OK, content, status_code)
+
+
+def get_content(url):
+    ''' Returns the decoded response body of url as bytes, or None if there
+        is no page or it could not be retrieved
+    '''
+    return fetch(url).content
+
+
+''' Parser and compiled XPaths of each thread, lxml objects are not to be
+    used by two threads at once
+'''
+_local = threading.local()
+
+
+def get_html_parser():
+    ''' Returns this thread's HTML parser, created on first use and reused
+        for every document after
+    '''
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        import lxml.html as lh
+        parser = _local.parser = lh.HTMLParser()
+    return parser
+
+
+def compile_xpath(path):
+    ''' Returns path compiled as an lxml XPath, compiled once per thread '''
+    xpaths = getattr(_local, 'xpaths', None)
+    if xpaths is None:
+        xpaths = _local.xpaths = {}
+
+    xpath = xpaths.get(path)
+    if xpath is None:
+        from lxml import etree
+        xpath = xpaths[path] = etree.XPath(path)
+    return xpath
+
+
+def parse_html(content, url=None):
+    ''' Parses response bytes as an lxml.html.HtmlElement object, or returns
+        None if they are not HTML
+
+        Parses the response bytes directly rather than decoding and encoding
+        a copy of them
+    '''
+    try:
+        with metrics.timed('html.parse'):
+            import lxml.html as lh
+            return lh.fromstring(content, parser=get_html_parser())
+    except Exception as err:
+        sys.stderr.write('Failed to parse {0}.\n'.format(url))
+        sys.stderr.write('{0}\n'.format(str(err)))
         return None
 
 
+def get_html(url):
+    ''' Get HTML response as an lxml.html.HtmlElement object, or None if
+        there is no page or it could not be retrieved
+    '''
+    content = get_content(url)
+    if content is None:
+        return None
+    return parse_html(content, url)
+
+
+def get_html_async(url):
+    ''' Starts fetching url in the background
+
+        Returns a multiprocessing AsyncResult, call .get() for the HTML
+    '''
+    return get_fetch_pool().apply_async(get_html, (url,))
+
+
+def get_many(urls):
+    ''' Fetches urls concurrently, returns their HTML in the same order '''
+    return get_fetch_pool().map(get_html, urls)
+
+
 def filter_printable(line):
     return [x for x in line if x in string.printable]
 
 
+''' Text of every element that is displayed '''
+TEXT_XPATH = '//*[not(self::script) and not(self::style)]//text()'
+
+
 def get_text(html):
-    text = html.xpath('//*[not(self::script) and not(self::style)]//text()')
+    text = compile_xpath(TEXT_XPATH)(html)
     return [filter_printable(x) for x in text]
 
 
+''' Matches an ABV percentage next to the letters ABV, or followed by ABC '''
+ABV_PATTERN = re.compile(r'(?<=[Aa][Bb][Vv])[^\d]*(\d+[.]?\d*)(?=%)|'
+                         r'(?<=%)[^\d]*(\d+[.]?\d*)[^\d]*(?=[Aa][Bb][Cc])')
+
+''' Bytes of a page to read before giving up on finding a match '''
+MAX_SCAN_BYTES = 512 * 1024
+
+''' Bytes read from a response at a time while scanning '''
+SCAN_CHUNK = 16 * 1024
+
+''' Characters of text carried between chunks so matches can span them '''
+SCAN_WINDOW = 512
+
+''' Markup whose text is not displayed and markup tags themselves '''
+_HIDDEN_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<!--.*?-->',
+                        re.I | re.S)
+_HIDDEN_OPEN_RE = re.compile(r'<(?:script|style)\b|<!--', re.I)
+_TAG_RE = re.compile(r'<[^>]*>')
+_ENTITY_RE = re.compile(r'&(#[xX]?[0-9a-fA-F]+|[a-zA-Z]+);')
+
+''' Bytes removed from text in bulk, the same set filter_printable drops '''
+_UNPRINTABLE = ''.join(chr(x) for x in xrange(256)
+                       if chr(x) not in string.printable)
+
+
+def decode_entity(match):
+    ''' Returns the printable ASCII character of an entity, otherwise '' '''
+    entity = match.group(1)
+    try:
+        if entity[:2] in ('#x', '#X'):
+            codepoint = int(entity[2:], 16)
+        elif entity[0] == '#':
+            codepoint = int(entity[1:])
+        else:
+            codepoint = name2codepoint[entity]
+    except (KeyError, ValueError):
+        return ''
+
+    if codepoint < 128 and chr(codepoint) in string.printable:
+        return chr(codepoint)
+    return ''
+
+
+class TextScanner(object):
+    ''' Searches the visible text of an HTML document fed in chunks
+
+        Markup, hidden elements and unprintable characters are stripped from
+        each chunk as it arrives, and pattern is searched over a window of the
+        last SCAN_WINDOW characters plus the new text
+    '''
+    def __init__(self, pattern=ABV_PATTERN, window=SCAN_WINDOW,
+                 max_pending=MAX_SCAN_BYTES):
+        self.pattern = pattern
+        self.window = window
+        self.max_pending = max_pending
+
+        ''' Markup held back until the tag, entity or hidden element ends '''
+        self.pending = ''
+
+        ''' Tail of the text already searched '''
+        self.text = ''
+
+        ''' Bytes fed so far '''
+        self.num_bytes = 0
+
+
+    def feed(self, chunk):
+        ''' Returns the first match of pattern once the text contains one '''
+        self.num_bytes += len(chunk)
+        raw = _HIDDEN_RE.sub('', self.pending + chunk)
+
+        ''' Hold back an unfinished hidden element, tag or entity '''
+        cut = len(raw)
+        hidden = _HIDDEN_OPEN_RE.search(raw)
+        if hidden:
+            cut = hidden.start()
+        tag = raw.rfind('<', 0, cut)
+        if tag != -1 and '>' not in raw[tag:cut]:
+            cut = tag
+        entity = raw.rfind('&', max(0, cut - 10), cut)
+        if entity != -1 and ';' not in raw[entity:cut]:
+            cut = entity
+
+        self.pending = raw[cut:]
+        if len(self.pending) > self.max_pending:
+            self.pending = ''
+
+        text = _TAG_RE.sub('', raw[:cut])
+        text = _ENTITY_RE.sub(decode_entity, text).translate(None,
+                                                              _UNPRINTABLE)
+
+        text = self.text + text
+        self.text = text[-self.window:]
+        return self.pattern.search(text)
+
+
+def scan_url(url, pattern=ABV_PATTERN, max_bytes=MAX_SCAN_BYTES,
+             cancelled=None, scanner=None):
+    ''' Returns the first match of pattern in the visible text of url
+
+        The response is read in chunks and reading stops at the first match,
+        after max_bytes or once the cancelled event is set, in which case None
+        is returned, as it is when there is no page. Raises IOError if the
+        page could not be retrieved. A TextScanner may be passed in place of
+        pattern to see how much was read
+    '''
+    if scanner is None:
+        scanner = TextScanner(pattern)
+
+    entry = None
+    headers = {}
+    if _http_cache is not None:
+        entry = _http_cache.get(url)
+        if entry is not None:
+            if entry.is_fresh():
+                metrics.count('cache.hits')
+                return scan_content(scanner, entry.body, max_bytes)
+            headers = entry.get_validators()
+        else:
+            metrics.count('cache.misses')
+
+    host = urlparse(url).netloc
+    chunks = None
+    num_bytes = 0
+    try:
+        with open_url(url, headers, stream=True) as response:
+            status_code = response.status_code
+            if entry is not None and status_code == 304:
+                metrics.count('cache.revalidated')
+                _http_cache.touch(url)
+                return scan_content(scanner, entry.body, max_bytes)
+            if is_failure(status_code):
+                raise IOError('HTTP {0}'.format(status_code))
+            if status_code != 200:
+                return None
+
+            ''' Keep the page for the cache only if it is read to the end '''
+            if _http_cache is not None:
+                chunks = []
+            for chunk in response.iter_content(SCAN_CHUNK):
+                if chunks is not None:
+                    chunks.append(chunk)
+                num_bytes += len(chunk)
+
+                with metrics.timed('abv.extract'):
+                    match = scanner.feed(chunk)
+                if match:
+                    return match
+
+                if num_bytes >= max_bytes or \
+                        (cancelled is not None and cancelled.is_set()):
+                    return None
+    except Exception as err:
+        sys.stderr.write('Failed to retrieve {0}.\n'.format(url))
+        sys.stderr.write('{0}\n'.format(str(err)))
+        raise IOError(str(err))
+    finally:
+        metrics.count('fetch.bytes', num_bytes)
+        metrics.count_domain(host, 'bytes', num_bytes)
+
+    if chunks is not None:
+        _http_cache.put(url, ''.join(chunks), response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+    return None
+
+
+def scan_content(scanner, content, max_bytes=MAX_SCAN_BYTES):
+    ''' Feeds an already retrieved body to scanner in chunks '''
+    for start in xrange(0, min(len(content), max_bytes), SCAN_CHUNK):
+        with metrics.timed('abv.extract'):
+            match = scanner.feed(content[start:start + SCAN_CHUNK])
+        if match:
+            return match
+    return None
+
+
+''' Gallons in a US beer barrel, for sizes given as a fraction of one '''
+BARREL_GALLONS = 31.0
+
+_BARREL_RE = re.compile(r'(\d+)\s*/\s*(\d+)\s*(?:bbl|barrel)', re.I)
+_NUMBER_RE = re.compile(r'\d+\.?\d*')
+_PRICE_RE = re.compile(r'\$\s*(\d[\d,]*\.?\d*)')
+
+
+def split_name(text):
+    ''' Splits a keg title like "Beer (15.5 Gal.)" into its name and volume
+
+        Returns a tuple of the name and the volume in gallons, 0.0 if the
+        title has no size in parentheses
+    '''
+    if '(' not in text or ')' not in text:
+        return text.strip(), 0.0
+
+    name, size = text.split('(', 1)
+    return name.strip(), parse_volume(size)
+
+
+def parse_volume(text):
+    ''' Returns the gallons in a size like "15.5 Gal." or "1/2 Barrel" '''
+    barrel = _BARREL_RE.search(text)
+    if barrel and int(barrel.group(2)):
+        return BARREL_GALLONS * int(barrel.group(1)) / int(barrel.group(2))
+
+    number = _NUMBER_RE.search(text)
+    if number:
+        return float(number.group())
+    return 0.0
+
+
+def parse_price(text):
+    ''' Returns the first dollar amount in text, or None if there is none '''
+    price = _PRICE_RE.search(text)
+    if price:
+        return float(price.group(1).replace(',', ''))
+    return None
+
+
 def is_num(num):
     ''' Characters to ignore when checking if value is a number '''
     ignore = ['-', '<', '>']
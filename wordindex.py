@@ -0,0 +1,102 @@
+import re
+
+
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    ''' Returns the set of lowercase words in text '''
+    return set(_WORD_RE.findall((text or '').lower()))
+
+
+def matches(words, all_of=None, none_of=None):
+    ''' Returns True if a keg's words hold every keyword of all_of and no
+        keyword of none_of
+
+        A keyword of several words matches when all of them are present
+    '''
+    for keyword in all_of or ():
+        if not tokenize(keyword) <= words:
+            return False
+    for keyword in none_of or ():
+        keyword_words = tokenize(keyword)
+        if keyword_words and keyword_words <= words:
+            return False
+    return True
+
+
+class WordIndex(object):
+    ''' Inverted index from the words of keg names and descriptions to the
+        beer ids of the kegs holding them
+    '''
+    def __init__(self, postings=None):
+        self.postings = {}
+        self.words = {}
+        for word, beer_ids in (postings or {}).items():
+            self.postings[word] = set(beer_ids)
+            for beer_id in beer_ids:
+                self.words.setdefault(beer_id, set()).add(word)
+
+
+    def __len__(self):
+        return len(self.words)
+
+
+    def add(self, beer_id, name, desc):
+        ''' Indexes a keg, replacing any earlier entry for its beer id '''
+        self.remove(beer_id)
+
+        words = tokenize(name) | tokenize(desc)
+        self.words[beer_id] = words
+        for word in words:
+            self.postings.setdefault(word, set()).add(beer_id)
+
+
+    def remove(self, beer_id):
+        for word in self.words.pop(beer_id, ()):
+            posting = self.postings[word]
+            posting.discard(beer_id)
+            if not posting:
+                del self.postings[word]
+
+
+    def get_posting(self, keyword):
+        ''' Returns the beer ids holding every word of a keyword '''
+        words = sorted(tokenize(keyword),
+                       key=lambda x: len(self.postings.get(x, ())))
+        if not words:
+            return set(self.words)
+
+        beer_ids = set(self.postings.get(words[0], ()))
+        for word in words[1:]:
+            if not beer_ids:
+                break
+            beer_ids &= self.postings.get(word, set())
+        return beer_ids
+
+
+    def query(self, all_of=None, none_of=None):
+        ''' Returns the beer ids matching every keyword of all_of and no
+            keyword of none_of
+
+            Postings are intersected smallest first, then the postings of
+            none_of are subtracted
+        '''
+        postings = sorted((self.get_posting(x) for x in all_of or ()), key=len)
+        if postings:
+            beer_ids = set(postings[0])
+            for posting in postings[1:]:
+                beer_ids &= posting
+        else:
+            beer_ids = set(self.words)
+
+        for keyword in none_of or ():
+            if tokenize(keyword):
+                beer_ids -= self.get_posting(keyword)
+        return beer_ids
+
+
+    def to_dict(self):
+        ''' Returns the postings as lists for saving '''
+        return dict((word, sorted(beer_ids))
+                    for word, beer_ids in self.postings.items())
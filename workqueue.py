@@ -0,0 +1,171 @@
+import json
+import os
+import socket
+import sqlite3
+import time
+
+
+''' Seconds a claimed item stays leased before another worker may take it '''
+LEASE_SECONDS = 300
+
+''' Times an item is claimed before it is given up on '''
+MAX_ATTEMPTS = 3
+
+
+def get_worker_name():
+    ''' Returns a name identifying this worker process across machines '''
+    return '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkItem(object):
+    ''' A url of a given kind claimed from a work queue '''
+    def __init__(self, item_id, kind, url, data, attempts):
+        self.item_id = item_id
+        self.kind = kind
+        self.url = url
+        self.data = data
+        self.attempts = attempts
+
+
+class WorkQueue(object):
+    ''' Durable queue of listing pages and kegs shared by crawl workers
+
+        Stored in a SQLite file any number of processes can open. Workers
+        claim items under a lease, and items whose lease ran out because
+        their worker crashed are claimed again until MAX_ATTEMPTS is reached.
+        Another backend only needs the same methods
+    '''
+    def __init__(self, path, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        ''' Transactions are begun explicitly so claims can lock the file '''
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.text_factory = str
+        self.conn.execute('CREATE TABLE IF NOT EXISTS items ('
+                          'item_id INTEGER PRIMARY KEY, kind TEXT, url TEXT, '
+                          'data TEXT, state TEXT, owner TEXT, '
+                          'lease_expires REAL, attempts INTEGER, '
+                          'UNIQUE (kind, url))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS items_state '
+                          'ON items (state, item_id)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results ('
+                          'key TEXT PRIMARY KEY, record TEXT)')
+
+
+    def put(self, kind, url, data=None):
+        ''' Queues a url, returns False if it was queued before '''
+        cursor = self.conn.execute('INSERT OR IGNORE INTO items (kind, url, '
+                                   'data, state, attempts) VALUES '
+                                   '(?, ?, ?, ?, 0)',
+                                   (kind, url, json.dumps(data), 'pending'))
+        return cursor.rowcount > 0
+
+
+    def put_many(self, kind, items, max_items=None):
+        ''' Queues (url, data) tuples in one transaction, stopping once
+            max_items of the kind are queued if given
+
+            Returns the number of urls not queued before
+        '''
+        num_queued = 0
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            room = None
+            if max_items is not None:
+                room = max_items - self.count(kind)
+
+            for url, data in items:
+                if room is not None and num_queued >= room:
+                    break
+                if self.put(kind, url, data):
+                    num_queued += 1
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return num_queued
+
+
+    def claim(self, owner, num_items):
+        ''' Leases up to num_items pending or expired items to owner
+
+            Returns a list of WorkItem objects, oldest first
+        '''
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            ''' Give up on expired items that used up their attempts '''
+            self.conn.execute('UPDATE items SET state = ? WHERE state = ? '
+                              'AND lease_expires < ? AND attempts >= ?',
+                              ('failed', 'leased', now, self.max_attempts))
+
+            rows = self.conn.execute('SELECT item_id, kind, url, data, '
+                                     'attempts FROM items WHERE state = ? '
+                                     'OR (state = ? AND lease_expires < ?) '
+                                     'ORDER BY item_id LIMIT ?',
+                                     ('pending', 'leased', now,
+                                      num_items)).fetchall()
+
+            self.conn.executemany('UPDATE items SET state = ?, owner = ?, '
+                                  'lease_expires = ?, attempts = attempts + 1 '
+                                  'WHERE item_id = ?',
+                                  [('leased', owner, now + self.lease_seconds,
+                                    row[0]) for row in rows])
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        return [WorkItem(item_id, kind, url, json.loads(data), attempts + 1)
+                for item_id, kind, url, data, attempts in rows]
+
+
+    def complete(self, item):
+        ''' Marks a claimed item done '''
+        self.conn.execute('UPDATE items SET state = ? WHERE item_id = ?',
+                          ('done', item.item_id))
+
+
+    def release(self, item):
+        ''' Returns a claimed item that failed to the queue, or gives up on it
+            once it used up its attempts
+        '''
+        state = 'failed' if item.attempts >= self.max_attempts else 'pending'
+        self.conn.execute('UPDATE items SET state = ? WHERE item_id = ?',
+                          (state, item.item_id))
+
+
+    def count(self, kind=None, states=None):
+        ''' Returns the number of items of a kind in any of states '''
+        query = 'SELECT COUNT(*) FROM items WHERE 1'
+        params = []
+        if kind is not None:
+            query += ' AND kind = ?'
+            params.append(kind)
+        if states is not None:
+            query += ' AND state IN ({0})'.format(','.join('?' * len(states)))
+            params.extend(states)
+        return self.conn.execute(query, params).fetchone()[0]
+
+
+    def is_drained(self):
+        ''' Returns True once no item is pending or leased '''
+        return self.count(states=('pending', 'leased')) == 0
+
+
+    def put_result(self, key, record):
+        self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                          (key, json.dumps(record)))
+
+
+    def get_results(self):
+        ''' Returns every result record by key '''
+        rows = self.conn.execute('SELECT key, record FROM results')
+        return dict((key, json.loads(record)) for key, record in rows)
+
+
+    def close(self):
+        self.conn.close()